@@ -0,0 +1,263 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Replays a message corpus through HlMon.watch_highlights with Discord and
+# Postgres stubbed out, and reports throughput, latency and allocations.
+#
+# Run from the repository root, with a filled out config:
+#
+#     python -m bench.highlights --highlights 100000 --regex-ratio 0.05
+import argparse
+import asyncio
+import random
+import string
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+from types import SimpleNamespace
+
+from neo.ext.highlight import MAX_HIGHLIGHTS, HlMon
+
+READABLE = SimpleNamespace(read_messages=True)
+
+
+class FakeRecord(dict):
+    """Iterates over its values, like an asyncpg Record"""
+
+    def __iter__(self):
+        return iter(self.values())
+
+
+class FakePool:
+    def __init__(self, records):
+        self.records = records
+
+    async def fetch(self, query, *args):
+        if args:
+            return [r for r in self.records if r["user_id"] == args[0]]
+        return self.records
+
+
+class FakeUserCache:
+    async def fetch(self, user_id):
+        return None
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.bot = False
+        self.default_avatar = SimpleNamespace(value=user_id % 5)
+
+    def __str__(self):
+        return f"{self.name}#0001"
+
+
+class FakeGuild:
+    def __init__(self, guild_id, member_ids):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self._members = {user_id: FakeUser(user_id) for user_id in member_ids}
+        self.member_count = len(self._members)
+        self.channels = [FakeChannel(guild_id * 100 + i, self) for i in range(10)]
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.name = f"channel{channel_id}"
+        self.guild = guild
+
+    def permissions_for(self, member):
+        return READABLE
+
+    async def history(self, **kwargs):
+        return
+        yield
+
+
+class FakeMessage:
+    def __init__(self, message_id, channel, author, content):
+        self.id = message_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embeds = []
+        self.attachments = []
+        self.created_at = datetime.utcnow()
+        self.jump_url = "https://discord.com/channels/{0}/{1}/{2}".format(
+            self.guild.id, channel.id, message_id
+        )
+
+
+class FakeBot:
+    def __init__(self, guilds, records):
+        self.loop = asyncio.get_running_loop()
+        self.guilds = guilds
+        self.pool = FakePool(records)
+        self.user_cache = FakeUserCache()
+        self.cached_messages = deque(maxlen=1000)  # Like the gateway's cache
+        self._users = {}
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_user(self, user_id):
+        if (user := self._users.get(user_id)) is None:
+            user = self._users[user_id] = FakeUser(user_id)
+        return user
+
+    def get_emoji(self, emoji_id):
+        return None
+
+
+def make_vocabulary(rng, size):
+    return [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+        for _ in range(size)
+    ]
+
+
+def make_highlights(rng, vocabulary, count, regex_ratio):
+    records = []
+    user_id = 1
+    while len(records) < count:
+        for _ in range(min(rng.randint(1, MAX_HIGHLIGHTS), count - len(records))):
+            words = rng.sample(vocabulary, rng.choices((1, 2), (7, 3))[0])
+            if is_regex := rng.random() < regex_ratio:
+                kw = rf"\b{words[0]}\d*s?\b"
+            else:
+                kw = " ".join(words)
+            records.append(FakeRecord(user_id=user_id, kw=kw, is_regex=is_regex))
+        user_id += 1
+    return records, user_id - 1
+
+
+def make_guilds(rng, count, members, owners):
+    guilds = []
+    for guild_id in range(1, count + 1):
+        sampled = rng.sample(range(1, owners + 1), min(owners, members // 4))
+        first = 10 ** 6 + guild_id * members  # IDs no highlight owner has
+        bystanders = range(first, first + members)
+        guilds.append(FakeGuild(guild_id, [*sampled, *bystanders][:members]))
+    return guilds
+
+
+def make_corpus(rng, vocabulary, guilds, count):
+    messages = []
+    for message_id in range(1, count + 1):
+        guild = rng.choice(guilds)
+        content = " ".join(rng.choices(vocabulary, k=rng.randint(3, 40)))
+        author = FakeUser(10 ** 9 + rng.randint(0, 1000))
+        messages.append(
+            FakeMessage(message_id, rng.choice(guild.channels), author, content)
+        )
+    return messages
+
+
+def percentile(ordered, percent):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+async def replay(mon, messages):
+    latencies = []
+    for message in messages:
+        mon.bot.cached_messages.append(message)  # Cached before dispatch
+        start = time.perf_counter()
+        await mon.watch_highlights(message)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, args.vocabulary)
+    records, owners = make_highlights(
+        rng, vocabulary, args.highlights, args.regex_ratio
+    )
+    guilds = make_guilds(rng, args.guilds, args.members, owners)
+    messages = make_corpus(rng, vocabulary, guilds, args.messages)
+    bot = FakeBot(guilds, records)
+
+    start = time.perf_counter()
+    mon = HlMon(bot)
+    await mon.update_highlight_cache()
+    print(
+        f"Loaded {len(records):,d} highlights for {owners:,d} users "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+    hits = 0
+
+    async def put(pending):
+        nonlocal hits
+        hits += 1
+
+    mon.dispatcher.put = put
+    try:
+        await replay(mon, messages[: args.warmup])  # Also starts the regex worker
+        hits = 0
+        start = time.perf_counter()
+        latencies = sorted(await replay(mon, messages))
+        elapsed = time.perf_counter() - start
+        sent = hits
+
+        tracemalloc.start()
+        await replay(mon, messages[: args.traced])
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+    finally:
+        mon.cog_unload()
+
+    print(f"{len(messages) / elapsed:,.0f} messages/sec, {sent:,d} highlights sent")
+    print(
+        f"p50 {percentile(latencies, 50) * 1000:.3f}ms, "
+        f"p99 {percentile(latencies, 99) * 1000:.3f}ms, "
+        f"max {latencies[-1] * 1000:.3f}ms"
+    )
+    print(
+        f"Allocations over {min(args.traced, len(messages)):,d} messages: "
+        f"{current / 1024:,.1f}KiB retained, {peak / 1024:,.1f}KiB peak"
+    )
+    for stat in snapshot.statistics("lineno")[: args.top]:
+        print(f"  {stat}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark highlight matching")
+    parser.add_argument("--highlights", type=int, default=10_000)
+    parser.add_argument("--regex-ratio", type=float, default=0.1)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--members", type=int, default=2_000)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--vocabulary", type=int, default=20_000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--traced", type=int, default=1_000)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -15,6 +15,7 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
+import asyncio
 import logging
 import aiohttp
 import asyncpg
@@ -23,11 +24,12 @@ import neo
 import sys
 from .config_loader import *  # noqa
 from .context import Context
+from .routing import MessageRouter
 from contextlib import suppress
 from discord.ext import commands
-from neo.types import DbCache
+from neo.types import DbCache, LazyDbCache
 
-__all__ = ("NeoBot",)
+__all__ = ("NeoBot", "PrefixIndex")
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +52,28 @@ if sys.platform == "win32":
 
     windll.kernel32.SetConsoleMode(windll.kernel32.GetStdHandle(-11), 7)
 
+DEFAULT_PREFIXES = ("n/",)
+# The cache_changes triggers in schema.sql and upgrade.sql list these too
+USER_COLUMNS = (
+    "repr_errors",
+    "error_emojis",
+    "hl_blocks",
+    "hl_whitelist",
+    "can_snipe",
+    "dm_reminders",
+    "_blacklisted",
+)
+GUILD_COLUMNS = (
+    "prefixes",
+    "index_emojis",
+    "snipes",
+    "starboard",
+    "starboard_star_requirement",
+    "starboard_channel_id",
+    "starboard_format",
+    "starboard_max_days",
+)
+
 LOGGERS = [("discord", logging.INFO), ("neo", logging.INFO)]
 
 
@@ -90,17 +114,44 @@ for name, level in LOGGERS:
     log_.addHandler(handler)
 
 
+class PrefixIndex:
+    """Holds a precompiled tuple of prefixes, mentions included, per guild
+
+    Each tuple remembers the prefixes it was built from, and is only rebuilt
+    once the guild's cached row carries a different prefixes object, which
+    happens when the row is replaced after a prefix or guild change."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._matchers = {}
+
+    def _compile(self, prefixes):
+        user_id = self.bot.user.id
+        # Longest first so that no prefix shadows a longer one it starts
+        return (
+            f"<@{user_id}> ",
+            f"<@!{user_id}> ",
+            *sorted({*prefixes}, key=len, reverse=True),
+        )
+
+    def get(self, guild_id):
+        row = self.bot.guild_cache.get(guild_id) if guild_id else None
+        source = row["prefixes"] if row else None
+        entry = self._matchers.get(guild_id)
+        if entry is None or entry[0] is not source:
+            prefixes = DEFAULT_PREFIXES if source is None else source
+            entry = self._matchers[guild_id] = (source, self._compile(prefixes))
+        return entry[1]
+
+    def invalidate(self, guild_id):
+        self._matchers.pop(guild_id, None)
+
+
 async def get_prefix(bot, message):
     if bot.is_closed():
         return
     await bot.wait_until_ready()
-    prefix = ["n/"]
-    if message.guild:
-        with suppress(
-            KeyError
-        ):  # Not sure why this *would* happen but I guess it could
-            prefix = list({*bot.guild_cache[message.guild.id]["prefixes"]})
-    return commands.when_mentioned_or(*prefix)(bot, message)
+    return bot.prefixes.get(getattr(message.guild, "id", None))
 
 
 class NeoBot(commands.Bot):
@@ -128,6 +179,9 @@ class NeoBot(commands.Bot):
             ),
         )
         self.snipes = {}
+        self.prefixes = PrefixIndex(self)
+        self.router = MessageRouter(self)
+        self._cache_listener = None
         self.loop.create_task(self.__ainit__())
         self._cd = commands.CooldownMapping.from_cooldown(
             2.0, 2.5, commands.BucketType.user
@@ -142,21 +196,83 @@ class NeoBot(commands.Bot):
     async def __ainit__(self):
         self.session = aiohttp.ClientSession()
         self.pool = await asyncpg.create_pool(**neo.secrets.database)
-        self.user_cache = await DbCache(
-            db_query="SELECT * FROM user_data", key="user_id", pool=self.pool
+        self.user_cache = await LazyDbCache(
+            table="user_data",
+            key="user_id",
+            columns=USER_COLUMNS,
+            pool=self.pool,
+            max_size=neo.conf.get("user_cache_size") or 10_000,
         )
         self.guild_cache = await DbCache(
-            db_query="SELECT * FROM guild_prefs", key="guild_id", pool=self.pool
+            table="guild_prefs", key="guild_id", columns=GUILD_COLUMNS, pool=self.pool
         )
+        if neo.conf.get("cache_coherence"):
+            await self._listen_for_cache_changes()
+
+    async def _listen_for_cache_changes(self):
+        connection = await asyncpg.connect(**neo.secrets.database)
+        try:
+            for cache in (self.user_cache, self.guild_cache):
+                await cache.listen(connection)
+        except Exception:
+            connection.terminate()
+            raise
+        connection.add_termination_listener(self._on_cache_listener_lost)
+        self._cache_listener = connection
+
+    def _on_cache_listener_lost(self, connection):
+        if self.is_closed():
+            return
+        log.warning("Lost the cache listener connection, reconnecting")
+        self.loop.create_task(self._reconnect_cache_listener())
+
+    async def _reconnect_cache_listener(self):
+        delay = 1
+        while not self.is_closed():
+            try:
+                await self._listen_for_cache_changes()
+            except Exception:
+                log.exception(
+                    f"Failed to reconnect the cache listener, retrying in {delay}s"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+            # Anything sent while disconnected was missed, so resync once
+            try:
+                await self.user_cache.refresh()
+                await self.guild_cache.refresh()
+            except Exception:
+                log.exception("Failed to resync caches after reconnecting")
+            return
 
     def run(self):
         super().run(neo.secrets.bot_token)
 
+    def add_cog(self, cog):
+        super().add_cog(cog)
+        self.router.add_cog(cog)
+
+    def remove_cog(self, name):
+        if (cog := self.get_cog(name)) is not None:
+            self.router.remove_cog(cog)
+        super().remove_cog(name)
+
+    async def on_message(self, message):
+        for callback in self.router.match(message):
+            self._schedule_event(callback, "on_message", message)
+        if not message.author.bot:
+            await self.process_commands(message)
+
+    async def get_prefix(self, message):
+        # commands.Bot would copy the prefix tuple into a new list per message
+        return await get_prefix(self, message)
+
     async def get_context(self, message, *, cls=Context):
         return await super().get_context(message, cls=cls)
 
-    def check_blacklist(self, ctx):
-        if (p := self.user_cache.get(ctx.author.id)) :
+    async def check_blacklist(self, ctx):
+        if (p := await self.user_cache.fetch(ctx.author.id)) :
             if p["_blacklisted"] is True:
                 raise neo.utils.errors.Blacklisted()
             else:
@@ -172,13 +288,17 @@ class NeoBot(commands.Bot):
         return True
 
     async def before(self, ctx):
-        if not self.user_cache.get(ctx.author.id):
-            with suppress(asyncpg.exceptions.UniqueViolationError):
-                await self.pool.execute(
-                    "INSERT INTO user_data (user_id) VALUES ($1)", ctx.author.id
-                )
+        if not await self.user_cache.fetch(ctx.author.id):
+            try:
                 # Adds people to the user_data table whenever they execute their first command
-                await self.user_cache.refresh()  # And then updates the user cache
+                row = await self.pool.fetchrow(
+                    "INSERT INTO user_data (user_id) VALUES ($1) RETURNING *",
+                    ctx.author.id,
+                )
+            except asyncpg.exceptions.UniqueViolationError:
+                await self.user_cache.upsert(ctx.author.id)
+            else:
+                self.user_cache.apply(row)  # And then caches only their row
 
     async def on_ready(self):
         log.info("Received ready event")
@@ -191,4 +311,6 @@ class NeoBot(commands.Bot):
         await super().close()
         with suppress(Exception):
             await self.session.close()
+            if self._cache_listener:
+                await self._cache_listener.close()
             await self.pool.close()
@@ -0,0 +1,81 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import inspect
+from collections import namedtuple
+
+__all__ = ("route", "MessageRouter")
+
+Route = namedtuple(
+    "Route", "cog callback guild_only ignore_bots channels guild_flag"
+)
+
+
+def route(*, guild_only=False, ignore_bots=False, channels=None, guild_flag=None):
+    """Registers a cog method as a message handler with the bot's router
+
+    guild_only: skip messages sent outside of guilds
+    ignore_bots: skip messages sent by bots
+    channels: name of a cog attribute holding the channel IDs to handle
+    guild_flag: a guild_prefs column which must be truthy for the guild
+    """
+
+    def decorator(func):
+        func.__route__ = dict(
+            guild_only=guild_only or guild_flag is not None,
+            ignore_bots=ignore_bots,
+            channels=channels,
+            guild_flag=guild_flag,
+        )
+        return func
+
+    return decorator
+
+
+class MessageRouter:
+    """Decides which message handlers should run for a message
+
+    Filters are checked here in one pass, so a handler is only scheduled
+    for the messages it is able to act on."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.routes = []
+
+    def add_cog(self, cog):
+        for name, member in inspect.getmembers(type(cog)):
+            if (options := getattr(member, "__route__", None)) is not None:
+                self.routes.append(Route(cog, getattr(cog, name), **options))
+
+    def remove_cog(self, cog):
+        self.routes = [r for r in self.routes if r.cog is not cog]
+
+    def match(self, message):
+        guild = message.guild
+        is_bot = message.author.bot
+        for r in self.routes:
+            if r.ignore_bots and is_bot:
+                continue
+            if r.guild_only and guild is None:
+                continue
+            if r.channels and message.channel.id not in getattr(r.cog, r.channels):
+                continue
+            if r.guild_flag and not self.bot.guild_cache.get(guild.id, {}).get(
+                r.guild_flag
+            ):
+                continue
+            yield r.callback
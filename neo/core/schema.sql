@@ -1,3 +1,5 @@
+-- Creates a fresh database, existing ones are brought up to date with upgrade.sql
+
 CREATE TYPE counting AS ( channel_id BIGINT, current_number BIGINT );
 
 CREATE TABLE user_data (
@@ -7,6 +9,7 @@ CREATE TABLE user_data (
     hl_blocks     BIGINT[] DEFAULT ARRAY[]::BIGINT[],
     hl_whitelist  BIGINT[] DEFAULT ARRAY[]::BIGINT[],
     can_snipe     BOOLEAN  DEFAULT TRUE,
+    dm_reminders  BOOLEAN  DEFAULT FALSE,
     _blacklisted  BOOLEAN  DEFAULT FALSE
 );
 
@@ -17,14 +20,19 @@ CREATE TABLE highlights (
     PRIMARY KEY(user_id, kw, is_regex)
 );
 
+-- Starts above the IDs previously derived from timestamps
+CREATE SEQUENCE reminders_id_seq START 1000000;
+
 CREATE TABLE reminders (
     user_id  BIGINT NOT NULL,
     content  VARCHAR(200) DEFAULT '...',
     deadline TIMESTAMP WITHOUT TIME ZONE NOT NULL,
-    id       BIGINT NOT NULL,
+    id       BIGINT NOT NULL DEFAULT nextval('reminders_id_seq'),
     origin_jump TEXT
 );
 
+CREATE INDEX reminders_deadline ON reminders (deadline, id);
+
 CREATE TABLE guild_prefs (
     guild_id     BIGINT PRIMARY KEY NOT NULL,
     prefixes     TEXT[] DEFAULT ARRAY[]::TEXT[],
@@ -47,13 +55,18 @@ CREATE TABLE starboard_msgs (
     PRIMARY KEY (message_id, channel_id, guild_id)
 );
 
+CREATE INDEX starboard_msgs_leaderboard ON starboard_msgs (guild_id, stars DESC);
+
 CREATE TABLE todo (
+    id BIGSERIAL,
     user_id bigint NOT NULL,
     content TEXT NOT NULL,
     jump_url TEXT,
-    created_at TIMESTAMP WITHOUT TIME ZONE
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() at time zone 'utc')
 );
 
+CREATE INDEX todo_listing ON todo (user_id, created_at, id);
+
 CREATE OR REPLACE FUNCTION change_starboard(new_destination BIGINT, _guild_id BIGINT) RETURNS void AS $$
 BEGIN
         DELETE FROM starboard_msgs WHERE starboard_msgs.guild_id = _guild_id;
@@ -61,4 +74,37 @@ BEGIN
         SET starboard_channel_id = new_destination
         WHERE guild_prefs.guild_id = _guild_id;
 END;
-$$ LANGUAGE plpgsql;
\ No newline at end of file
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_cache_change() RETURNS TRIGGER AS $$
+DECLARE
+        changed JSONB;
+BEGIN
+        IF TG_OP = 'DELETE' THEN
+                changed := to_jsonb(OLD);
+        ELSE
+                changed := to_jsonb(NEW);
+        END IF;
+        -- Only the key is sent, caches refetch the row themselves
+        PERFORM pg_notify(
+                TG_TABLE_NAME || '_changes',
+                json_build_object('op', TG_OP, 'key', changed -> TG_ARGV[0])::TEXT
+        );
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only changes to the columns cached in neo/core/__init__.py are sent
+CREATE TRIGGER user_data_changes
+AFTER INSERT OR DELETE OR UPDATE OF
+        repr_errors, error_emojis, hl_blocks, hl_whitelist, can_snipe,
+        dm_reminders, _blacklisted
+ON user_data
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('user_id');
+
+CREATE TRIGGER guild_prefs_changes
+AFTER INSERT OR DELETE OR UPDATE OF
+        prefixes, index_emojis, snipes, starboard, starboard_star_requirement,
+        starboard_channel_id, starboard_format, starboard_max_days
+ON guild_prefs
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('guild_id');
@@ -0,0 +1,63 @@
+-- Brings a database created from an older schema.sql up to date.
+-- Every statement is safe to run again on an up to date database.
+
+-- Cached user rows are selected by column, so every cached column must exist
+ALTER TABLE user_data ADD COLUMN IF NOT EXISTS dm_reminders BOOLEAN DEFAULT FALSE;
+
+-- Reminder IDs are issued by a sequence, starting above both the IDs
+-- previously derived from timestamps and any already stored
+CREATE SEQUENCE IF NOT EXISTS reminders_id_seq START 1000000;
+ALTER TABLE reminders ALTER COLUMN id SET DEFAULT nextval('reminders_id_seq');
+SELECT setval(
+    'reminders_id_seq',
+    GREATEST(
+        (SELECT COALESCE(max(id), 0) + 1 FROM reminders),
+        1000000
+    ),
+    false
+);
+CREATE INDEX IF NOT EXISTS reminders_deadline ON reminders (deadline, id);
+
+-- Todos are listed by (created_at, id), which needs both to be set. Undated
+-- todos were listed last, which they stay by being dated now
+ALTER TABLE todo ADD COLUMN IF NOT EXISTS id BIGSERIAL;
+UPDATE todo SET created_at = now() at time zone 'utc' WHERE created_at IS NULL;
+ALTER TABLE todo
+    ALTER COLUMN created_at SET DEFAULT (now() at time zone 'utc'),
+    ALTER COLUMN created_at SET NOT NULL;
+CREATE INDEX IF NOT EXISTS todo_listing ON todo (user_id, created_at, id);
+
+-- Cache coherence is notified of changes to cached columns by these triggers
+CREATE OR REPLACE FUNCTION notify_cache_change() RETURNS TRIGGER AS $$
+DECLARE
+        changed JSONB;
+BEGIN
+        IF TG_OP = 'DELETE' THEN
+                changed := to_jsonb(OLD);
+        ELSE
+                changed := to_jsonb(NEW);
+        END IF;
+        -- Only the key is sent, caches refetch the row themselves
+        PERFORM pg_notify(
+                TG_TABLE_NAME || '_changes',
+                json_build_object('op', TG_OP, 'key', changed -> TG_ARGV[0])::TEXT
+        );
+        RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_data_changes ON user_data;
+CREATE TRIGGER user_data_changes
+AFTER INSERT OR DELETE OR UPDATE OF
+        repr_errors, error_emojis, hl_blocks, hl_whitelist, can_snipe,
+        dm_reminders, _blacklisted
+ON user_data
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('user_id');
+
+DROP TRIGGER IF EXISTS guild_prefs_changes ON guild_prefs;
+CREATE TRIGGER guild_prefs_changes
+AFTER INSERT OR DELETE OR UPDATE OF
+        prefixes, index_emojis, snipes, starboard, starboard_star_requirement,
+        starboard_channel_id, starboard_format, starboard_max_days
+ON guild_prefs
+FOR EACH ROW EXECUTE PROCEDURE notify_cache_change('guild_id');
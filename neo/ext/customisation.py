@@ -16,13 +16,14 @@ You should have received a copy of the GNU Affero General Public License
 along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
+import heapq
+import logging
 import re
 import string
 from contextlib import suppress
-from datetime import datetime
+from datetime import datetime, timedelta
 from random import Random
 from textwrap import indent, shorten
-from time import time
 from typing import Union
 
 import discord
@@ -34,60 +35,192 @@ from neo.utils.converters import BoolConverter, TimeConverter
 from neo.utils.formatters import prettify_text
 from yarl import URL
 
+log = logging.getLogger(__name__)
+
 
 class Reminder:
-    def __init__(self, *, user, bot, content, deadline, rm_id, jump_origin):
+    def __init__(self, *, user, user_id, bot, content, deadline, rm_id, jump_origin):
         self.user = user
+        self.user_id = user_id  # Kept as the user may not be cached
         self.content = content
         self.deadline = deadline
         self.rm_id = rm_id
         self.jump_origin = URL(jump_origin)
         self.bot = bot
-        self.task = bot.loop.create_task(self._do_wait(), name=f"REMINDER-{self.rm_id}")
 
     def __repr__(self):
         attrs = " ".join(f"{k}={v!r}" for k, v in self.__dict__.items())
         return f"<{self.__class__.__name__} {attrs}>"
 
-    async def _do_wait(self):
-        await discord.utils.sleep_until(self.deadline)
-        await self._do_remind()
-
     async def _do_remind(self):
+        """Sends the reminder, removing it is left to the scheduler"""
         target = self.bot.get_channel(int(self.jump_origin.parts[3])) or self.user
         if self.user is None:
-            return await self.bot.pool.execute(
-                "DELETE FROM reminders WHERE id=$1", self.rm_id
-            )
+            return
 
-        if self.bot.user_cache[self.user.id].get("dm_reminders", False) is True:
+        settings = await self.bot.user_cache.fetch(self.user.id) or {}
+        if settings.get("dm_reminders", False) is True:
             target = self.user
 
         original_reference = discord.PartialMessage(
             channel=target, id=int(self.jump_origin.parts[-1])
         )
 
-        try:
-            await target.send(
-                self.content,
-                allowed_mentions=discord.AllowedMentions(users=[self.user]),
-                reference=original_reference.to_reference(),
+        await target.send(
+            self.content,
+            allowed_mentions=discord.AllowedMentions(users=[self.user]),
+            reference=original_reference.to_reference(),
+        )
+
+
+class ReminderScheduler:
+    """Runs reminders from a single task
+
+    Only reminders due within ``window`` are held, in a min-heap ordered by
+    deadline, and the task sleeps until the earliest of them. Reminders due
+    later stay in the database, and are paged in as the window advances.
+
+    Reminders which come due together are delivered as one batch, at most
+    ``concurrency`` at once, and then deleted together."""
+
+    def __init__(
+        self, bot, *, window=timedelta(hours=1), page_size=500, concurrency=5
+    ):
+        self.bot = bot
+        self._sending = asyncio.Semaphore(concurrency)
+        self.window = window
+        self.page_size = page_size
+        self.heap = []  # (deadline, ID, reminder)
+        self.reminders = {}  # ID -> reminder, for everything in the heap
+        self.by_user = {}  # user ID -> IDs of their reminders in the heap
+        self.loaded_until = None
+        self._wakeup = asyncio.Event()
+        self._task = bot.loop.create_task(self._run())
+
+    def add(self, reminder):
+        """Schedules a reminder, unless it's due past the loaded window"""
+        if self.loaded_until is None or reminder.deadline > self.loaded_until:
+            return  # It'll be paged in later
+        if reminder.rm_id in self.reminders:
+            return
+        self.reminders[reminder.rm_id] = reminder
+        self.by_user.setdefault(reminder.user_id, set()).add(reminder.rm_id)
+        heapq.heappush(self.heap, (reminder.deadline, reminder.rm_id, reminder))
+        if self.heap[0][2] is reminder:
+            self._wakeup.set()
+
+    def _forget(self, reminder):
+        del self.reminders[reminder.rm_id]
+        ids = self.by_user[reminder.user_id]
+        ids.discard(reminder.rm_id)
+        if not ids:
+            del self.by_user[reminder.user_id]
+
+    def cancel(self, rm_id, user_id):
+        """Cancels one of a user's reminders, if it's held"""
+        if (reminder := self.reminders.get(rm_id)) and reminder.user_id == user_id:
+            # Left in the heap, it's skipped once it comes up
+            self._forget(reminder)
+
+    def cancel_user(self, user_id):
+        """Cancels every held reminder of a user"""
+        for rm_id in [*self.by_user.get(user_id, ())]:
+            self._forget(self.reminders[rm_id])
+
+    async def _load(self, until):
+        """Pages in the reminders due up to ``until`` which aren't held yet"""
+        # Moved first, so reminders created while this runs are added directly
+        since, self.loaded_until = self.loaded_until, until
+        query = """
+        SELECT * FROM reminders
+        WHERE deadline <= $1 AND (deadline, id) > ($2, $3)
+        ORDER BY deadline, id
+        LIMIT $4
+        """
+        after = (since or datetime.min, 2 ** 63 - 1)
+        while True:
+            records = await self.bot.pool.fetch(query, until, *after, self.page_size)
+            for record in records:
+                self.add(
+                    Reminder(
+                        user=self.bot.get_user(record["user_id"]),
+                        user_id=record["user_id"],
+                        content=record["content"],
+                        deadline=record["deadline"],
+                        bot=self.bot,
+                        rm_id=record["id"],
+                        jump_origin=record["origin_jump"],
+                    )
+                )
+            if len(records) < self.page_size:
+                return
+            after = (records[-1]["deadline"], records[-1]["id"])
+
+    def _pop_due(self):
+        now = datetime.utcnow()
+        while self.heap and self.heap[0][0] <= now:
+            *_, reminder = heapq.heappop(self.heap)
+            if self.reminders.get(reminder.rm_id) is reminder:
+                self._forget(reminder)
+                yield reminder
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        backoff = 1
+        while True:
+            try:
+                await self._step()
+            except Exception:
+                log.exception(f"Reminder scheduling failed, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+            else:
+                backoff = 1
+
+    async def _step(self):
+        now = datetime.utcnow()
+        if self.loaded_until is None or self.loaded_until - now < self.window / 2:
+            await self._load(now + self.window)
+        if due := [*self._pop_due()]:
+            self.bot.loop.create_task(self._deliver(due))
+
+        wake = self.loaded_until - self.window / 2
+        if self.heap:
+            wake = min(wake, self.heap[0][0])
+        self._wakeup.clear()
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                self._wakeup.wait(),
+                max(0, (wake - datetime.utcnow()).total_seconds()),
             )
 
-        finally:
+    async def _send(self, reminder):
+        async with self._sending:
+            await reminder._do_remind()
+
+    async def _deliver(self, due):
+        # Failed sends are dropped all the same, as a single reminder always was
+        results = await asyncio.gather(*map(self._send, due), return_exceptions=True)
+        for reminder, result in zip(due, results):
+            if isinstance(result, Exception):
+                log.warning(f"Failed to send reminder {reminder.rm_id}: {result!r}")
+        try:
             await self.bot.pool.execute(
-                "DELETE FROM reminders WHERE id=$1 AND user_id=$2",
-                self.rm_id,
-                self.user.id,
+                "DELETE FROM reminders WHERE id=ANY($1::bigint[])",
+                [reminder.rm_id for reminder in due],
             )
+        except Exception:
+            log.exception(f"Failed to delete {len(due)} delivered reminders")
+
+    def close(self):
+        self._task.cancel()
 
 
 class Customisation(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.max_highlights = 10
-        self.pending_reminders = list()
-        bot.loop.create_task(self._create_first_reminders())
+        self.reminders = ReminderScheduler(bot)
 
     @commands.command(name="settings")
     async def user_settings(
@@ -98,35 +231,32 @@ class Customisation(commands.Cog):
         new_setting: Union[BoolConverter, int, str] = None,
     ):
         """View and edit user settings"""
+        settings = await self.bot.user_cache.fetch(ctx.author.id)
         if setting_name is not None and new_setting is not None:
-            keys = [
-                *filter(
-                    lambda k: not k.startswith("_"),
-                    self.bot.user_cache.get(ctx.author.id).keys(),
-                )
-            ]
+            keys = [*filter(lambda k: not k.startswith("_"), settings.keys())]
             if setting_name not in keys:
                 raise commands.CommandError(
                     f"New setting must be one of {', '.join(keys)}"
                 )
             async with ctx.loading():
-                await self.bot.pool.execute(
-                    f"UPDATE user_data SET {setting_name}=$1 WHERE user_id=$2",
+                row = await self.bot.pool.fetchrow(
+                    f"UPDATE user_data SET {setting_name}=$1 WHERE user_id=$2 "
+                    "RETURNING *",
                     new_setting,
                     ctx.author.id,
                 )
-            await self.bot.user_cache.refresh()
+                self.bot.user_cache.apply(row)
             return
         embed = discord.Embed(title=f"""{ctx.author}'s Settings""")
         readable_settings = []
-        for k, v in self.bot.user_cache[ctx.author.id].items():
+        for k, v in settings.items():
             if k.startswith("_"):
                 continue
             if isinstance(v, bool):
                 readable_settings.append(
                     f"{ctx.toggle(v)} **{discord.utils.escape_markdown(k)}**"
                 )
-            elif isinstance(v, (list, str)) or v is None:
+            elif isinstance(v, (list, tuple, str)) or v is None:
                 continue
             else:
                 readable_settings.append(
@@ -151,12 +281,13 @@ class Customisation(commands.Cog):
                     f"New setting must be one of {', '.join(keys)}"
                 )
             async with ctx.loading():
-                await self.bot.pool.execute(
-                    f"UPDATE guild_prefs SET {setting_name}=$1 WHERE guild_id=$2",
+                row = await self.bot.pool.fetchrow(
+                    f"UPDATE guild_prefs SET {setting_name}=$1 WHERE guild_id=$2 "
+                    "RETURNING *",
                     new_setting,
                     ctx.guild.id,
                 )
-            await self.bot.guild_cache.refresh()
+                self.bot.guild_cache.apply(row)
             return
         embed = discord.Embed(title=f"""{ctx.guild}'s Settings""")
         readable_settings = []
@@ -207,12 +338,12 @@ class Customisation(commands.Cog):
             if strat == current_prefixes.add and len(current_prefixes) == 5:
                 raise commands.CommandError("A guild may have no more than 5 prefixes")
             strat(prefix)
-            await self.bot.pool.execute(
-                "UPDATE guild_prefs SET prefixes=$1 WHERE guild_id=$2",
+            row = await self.bot.pool.fetchrow(
+                "UPDATE guild_prefs SET prefixes=$1 WHERE guild_id=$2 RETURNING *",
                 current_prefixes,
                 ctx.guild.id,
             )
-            await self.bot.guild_cache.refresh()
+            self.bot.guild_cache.apply(row)
 
     @commands.group(aliases=["hl"], invoke_without_command=True, ignore_extra=False)
     async def highlight(self, ctx):
@@ -227,11 +358,7 @@ class Customisation(commands.Cog):
                 return f"`{index}` <:regex:735370786294202480> `{kw_full}`"
             return f"`{index}` `{kw_full}`"
 
-        my_hl = list(
-            filter(
-                lambda hl: hl.user_id == ctx.author.id, self.bot.get_cog("HlMon").cache
-            )
-        )
+        my_hl = self.bot.get_cog("HlMon").cache.get(ctx.author.id, [])
         await ctx.send(
             embed=discord.Embed(
                 description="\n".join(map(format_hl, enumerate(my_hl, 1)))
@@ -251,28 +378,41 @@ class Customisation(commands.Cog):
         """
         Base todo command, run with no arguments to see a list of all your active todos
         """
-        query = """
-        WITH enumerated AS (
-        SELECT row_number() OVER (ORDER BY created_at ASC) AS rnum,
-        todo.content AS cont, todo.jump_url AS jump FROM todo WHERE user_id=$1)
+        count = await self.bot.pool.fetchval(
+            "SELECT count(*) FROM todo WHERE user_id=$1", ctx.author.id
+        )
 
-        SELECT FORMAT('[`%s`](%s) %s', enumerated.rnum, 
-        enumerated.jump, enumerated.cont) f FROM enumerated
-        """
-        todos = [
-            shorten(r["f"], width=175)
-            for r in await self.bot.pool.fetch(query, ctx.author.id)
-        ]
-        await ctx.paginate(
-            todos,
-            10,
-            template=discord.Embed().set_author(
-                name=f"{ctx.author}'s todos ({len(todos):,} items)",
+        async def fetch(after, skip, limit):
+            query = """
+            SELECT id, created_at, content, jump_url FROM todo
+            WHERE user_id=$1 {0}
+            ORDER BY created_at, id
+            OFFSET ${1} LIMIT ${2}
+            """
+            if after is None:
+                query = query.format("", 2, 3)
+                return await self.bot.pool.fetch(query, ctx.author.id, skip, limit)
+            query = query.format("AND (created_at, id) > ($2, $3)", 4, 5)
+            return await self.bot.pool.fetch(
+                query, ctx.author.id, *after, skip, limit
+            )
+
+        source = neo.utils.KeysetPageSource(
+            fetch,
+            count=count,
+            per_page=10,
+            key=lambda r: (r["created_at"], r["id"]),
+            format_entry=lambda index, r: shorten(
+                f"[`{index}`]({r['jump_url'] or ''}) {r['content']}", width=175
+            ),
+            embed=discord.Embed().set_author(
+                name=f"{ctx.author}'s todos ({count:,} items)",
                 icon_url=ctx.author.avatar_url_as(static_format="png"),
             ),
-            delete_on_button=True,
-            clear_reactions_after=True,
         )
+        await neo.utils.CSMenu(
+            source, delete_on_button=True, clear_reactions_after=True
+        ).start(ctx)
 
     @todo_rw.command(name="add")
     async def create_todo(self, ctx, *, content: str):
@@ -299,11 +439,11 @@ class Customisation(commands.Cog):
             )
         query = """
         WITH enumerated AS (
-        SELECT todo.content,row_number() OVER (ORDER BY created_at ASC) AS rnum FROM todo WHERE user_id=$1
+        SELECT todo.id,row_number() OVER (ORDER BY created_at, id) AS rnum FROM todo WHERE user_id=$1
         )
 
-        DELETE FROM todo WHERE user_id=$1 AND content IN (
-        SELECT enumerated.content FROM enumerated WHERE enumerated.rnum=ANY($2::bigint[])
+        DELETE FROM todo WHERE user_id=$1 AND id IN (
+        SELECT enumerated.id FROM enumerated WHERE enumerated.rnum=ANY($2::bigint[])
         ) RETURNING content
         """
         deleted = await self.bot.pool.fetch(query, ctx.author.id, todo_index)
@@ -320,7 +460,7 @@ class Customisation(commands.Cog):
         query = """
         WITH enumerated AS (
         SELECT todo.content, todo.created_at,
-        row_number() OVER (ORDER BY created_at ASC) as rnum FROM todo WHERE user_id=$1)
+        row_number() OVER (ORDER BY created_at, id) as rnum FROM todo WHERE user_id=$1)
 
         SELECT * FROM enumerated WHERE enumerated.rnum=$2"""
         todo = await self.bot.pool.fetchrow(query, ctx.author.id, todo_index)
@@ -348,27 +488,26 @@ class Customisation(commands.Cog):
     # END TODOS GROUP ~
 
     @commands.group(name="remind", invoke_without_command=True)
-    @commands.max_concurrency(1, commands.BucketType.default)
     async def _remind(self, ctx, *, reminder: TimeConverter):
         """Add a new reminder. The first time/date found will be the one used."""
-        reminder_id = int(str(int(time()))[4:])
-        await self.bot.pool.execute(
-            "INSERT INTO reminders (user_id, content, deadline, id, origin_jump) VALUES ($1, $2, $3, $4, $5)",
+        reminder_id = await self.bot.pool.fetchval(
+            "INSERT INTO reminders (user_id, content, deadline, origin_jump) VALUES ($1, $2, $3, $4) RETURNING id",
             ctx.author.id,
             reminder.string,
             reminder.time,
-            reminder_id,
             ctx.message.jump_url,
         )
-        with suppress(UnboundLocalError):
+        self.reminders.add(
             Reminder(
                 user=ctx.author,
+                user_id=ctx.author.id,
                 content=reminder.string,
                 deadline=reminder.time,
                 bot=self.bot,
                 rm_id=reminder_id,
                 jump_origin=ctx.message.jump_url,
             )
+        )
         pretty_time = reminder.time.strftime("%a, %b %d, %Y at %H:%M:%S")
         await ctx.send(
             f"{ctx.tick(True)} Reminder set for {pretty_time} with ID `{reminder_id}`"
@@ -403,21 +542,11 @@ class Customisation(commands.Cog):
             clear_reactions_after=True,
         )
 
-    def get_running_reminders(self):
-        yield from filter(
-            lambda task: task.get_name().startswith("REMINDER"),
-            asyncio.all_tasks(self.bot.loop),
-        )
-
     @_remind.command(name="remove", aliases=["del", "rm"])
     async def _remind_remove(self, ctx, items: commands.Greedy[int]):
         """Remove one, or many reminders by their unique ID"""
-        running = [*self.get_running_reminders()]
-        [
-            task.cancel()
-            for task in running
-            if task.get_name().endswith(tuple(map(str, items)))
-        ]
+        for rm_id in items:
+            self.reminders.cancel(rm_id, ctx.author.id)
         deleted = await self.bot.pool.fetch(
             "DELETE FROM reminders WHERE id=ANY($1::bigint[]) AND user_id=$2 RETURNING content",
             items,
@@ -434,29 +563,13 @@ class Customisation(commands.Cog):
         """Cancels all of your active reminders"""
         confirm = await ctx.prompt("Are you sure you want to cancel all reminders?")
         if confirm:
-            cancelled = await self.bot.pool.fetch(
-                "DELETE FROM reminders WHERE user_id=$1 RETURNING id", ctx.author.id
-            )
-            [
-                task.cancel()
-                for task in self.get_running_reminders()
-                if task.get_name().endswith((*map(lambda r: str(r["id"]), cancelled),))
-            ]
-
-    async def _create_first_reminders(self):
-        await self.bot.wait_until_ready()
-        for record in await self.bot.pool.fetch("SELECT * FROM reminders"):
-            Reminder(
-                user=self.bot.get_user(record["user_id"]),
-                content=record["content"],
-                deadline=record["deadline"],
-                bot=self.bot,
-                rm_id=record["id"],
-                jump_origin=record["origin_jump"],
+            self.reminders.cancel_user(ctx.author.id)
+            await self.bot.pool.execute(
+                "DELETE FROM reminders WHERE user_id=$1", ctx.author.id
             )
 
     def cog_unload(self):
-        [task.cancel() for task in self.get_running_reminders()]
+        self.reminders.close()
 
 
 def setup(bot):
@@ -358,7 +358,7 @@ class Dev(commands.Cog):
             raise commands.CommandError("What the fuck no you don't get to do that")
 
         async with ctx.loading():
-            if not (_u := self.bot.user_cache.get(target)):
+            if not (_u := await self.bot.user_cache.fetch(target)):
                 with suppress(Exception):
                     await self.bot.pool.execute(
                         "INSERT INTO user_data (user_id) VALUES ($1)", target
@@ -366,12 +366,12 @@ class Dev(commands.Cog):
                 _blacklisted = False
             else:
                 _blacklisted = _u["_blacklisted"]
-            await self.bot.pool.execute(
-                "UPDATE user_data SET _blacklisted=$1 WHERE user_id=$2",
+            row = await self.bot.pool.fetchrow(
+                "UPDATE user_data SET _blacklisted=$1 WHERE user_id=$2 RETURNING *",
                 not _blacklisted,
                 target,
             )
-            await self.bot.user_cache.refresh()
+            self.bot.user_cache.apply(row)
 
 
 def setup(bot):
@@ -28,6 +28,7 @@ from typing import Union
 import discord
 from discord.ext import commands, flags, tasks
 from discord.ext.commands import has_permissions
+from neo.core.routing import route
 from neo.utils.checks import is_owner_or_administrator
 from neo.utils.converters import BoolConverter
 from neo.utils.formatters import prettify_text
@@ -43,6 +44,7 @@ class Guild(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self._counting_cache = collections.defaultdict(dict)
+        self.counting_channels = set()
         self._cache_ready = False
         self.locks = {}
         bot.loop.create_task(self.get_cache())
@@ -57,6 +59,10 @@ class Guild(commands.Cog):
                 continue
             self._counting_cache[_id] = dict(counting)
             self.locks[_id] = asyncio.Lock()
+        self.counting_channels.clear()
+        self.counting_channels.update(
+            c["channel_id"] for c in self._counting_cache.values() if c
+        )
         if not self._cache_ready:
             self.push_counting_data.start()
             self._cache_ready = True
@@ -194,11 +200,9 @@ class Guild(commands.Cog):
 
         await ctx.message.add_reaction(ctx.tick(True))
 
-    @commands.Cog.listener(name="on_message")
+    @route(guild_only=True, channels="counting_channels")
     async def check_counting(self, msg):
-        if not msg.guild:
-            return
-        elif not self._counting_cache.get(msg.guild.id):
+        if not self._counting_cache.get(msg.guild.id):
             return
         elif self._counting_cache[msg.guild.id]["channel_id"] != msg.channel.id:
             return
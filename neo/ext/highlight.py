@@ -16,19 +16,26 @@ You should have received a copy of the GNU Affero General Public License
 along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
+import logging
 import re
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
 from contextlib import suppress
 from textwrap import shorten
 
 import discord
 import neo
-from discord.ext import commands, flags, tasks
-from neo.types import TimedSet
+from discord.ext import commands, flags
+from neo.core.routing import route
+from neo.types import ExpiringSet, KeywordAutomaton
+from neo.utils import RegexSandbox
+
+log = logging.getLogger(__name__)
 
 # Constants
 MAX_HIGHLIGHTS = 10
-PendingHighlight = namedtuple("PendingHighlight", ["user", "embed", "text"])
+PendingHighlight = namedtuple(
+    "PendingHighlight", ["user", "embed", "text", "queued_at"]
+)
 
 regex_flag = re.compile(r"--?re(gex)?")
 excessive_or = re.compile(r"(?<!\\)\|")
@@ -40,6 +47,9 @@ regex_check = re.compile(
     re.I | re.X,
 )
 emoji_re = re.compile(r"<a?:[a-zA-Z0-9_]*:(?P<id>\d*)>", re.I)
+token_re = re.compile(
+    r"([a-zA-Z0-9]{24}\.[a-zA-Z0-9]{6}\.[a-zA-Z0-9_\-]{27}|mfa\.[a-zA-Z0-9_\-]{84})"
+)
 
 
 def check_regex(content):
@@ -77,6 +87,7 @@ class Highlight:
         self.user_id = user_id
         self.kw = kw
         self.is_regex = is_regex
+        self.key = (user_id, kw, is_regex)
         self.compiled = re.compile(fr"\b{re.escape(kw)}\b", re.I)
         if is_regex:
             try:
@@ -88,50 +99,16 @@ class Highlight:
         attrs = " ".join(f"{k}={v!r}" for k, v in self.__dict__.items())
         return f"<{self.__class__.__name__} {attrs}>"
 
-    def check_can_send(self, message, bot):
-        predicates = []
-        if not message.guild:
-            return False
-        if self.user_id not in [m.id for m in message.guild.members]:
-            return False
-        predicates.append(
-            not re.search(
-                re.compile(
-                    r"([a-zA-Z0-9]{24}\.[a-zA-Z0-9]{6}\.[a-zA-Z0-9_\-]{27}|mfa\.["
-                    r"a-zA-Z0-9_\-]{84})"
-                ),
-                message.content,
-            )
-        )
-        if wl := bot.user_cache[self.user_id]["hl_whitelist"]:
-            predicates.append(message.guild.id in wl)
-        if blocks := bot.user_cache[self.user_id]["hl_blocks"]:
-            predicates.extend(
-                [message.author.id not in blocks, message.guild.id not in blocks]
-            )
-        predicates.extend(
-            [
-                self.user_id != message.author.id,
-                message.channel.permissions_for(
-                    message.guild.get_member(self.user_id)
-                ).read_messages
-                is not False,
-                not message.author.bot,
-            ]
-        )
-        return all(predicates)
-
     @staticmethod
-    async def to_embed(match, message, bot):
+    def to_embed(match, message, context, bot):
         context_list = []
-        async for m in message.channel.history(limit=5):
+        for m in context:
             avatar_index = m.author.default_avatar.value
             hl_underline = (
                 m.content.replace(match, f"**__{match}__**")
                 if m.id == message.id
                 else m.content
             )
-            repl = r"<a?:\w*:\d*>"
             name = discord.utils.escape_markdown(m.author.name)
             content = (
                 f"{neo.conf['emojis']['default_avs'][avatar_index]} **{name}:** "
@@ -142,7 +119,6 @@ class Highlight:
             if m.attachments:
                 content += " 🖼️"
             context_list.append(content)
-        context_list.reverse()
         while len("\n".join(context_list)) > 2048:
             context_list = context_list[1:]
         embed = discord.Embed(
@@ -153,67 +129,414 @@ class Highlight:
         return embed
 
 
+class ContextProvider:
+    """Supplies the messages leading up to a highlighted message
+
+    Context is sliced out of the gateway's message cache, so that it can
+    usually be built without calling the API at all."""
+
+    def __init__(self, bot, size=5):
+        self.bot = bot
+        self.size = size
+
+    async def get(self, message):
+        """Returns up to ``size`` messages, oldest first, ending at ``message``"""
+        context = []
+        for m in reversed(self.bot.cached_messages):
+            if m.channel.id != message.channel.id or m.id > message.id:
+                continue
+            context.append(m)
+            if len(context) == self.size:
+                break
+        if len(context) == self.size and context[0].id == message.id:
+            return context[::-1]
+        history = message.channel.history(
+            limit=self.size, before=discord.Object(message.id + 1)
+        )
+        return [m async for m in history][::-1]
+
+
+class HighlightDispatcher:
+    """Delivers highlights, coalescing each recipient's hits into one DM
+
+    Hits are held per recipient for ``delay`` seconds and then sent as a
+    single message. At most ``concurrency`` recipients are sent to at once,
+    and once ``max_pending`` hits are waiting, producers wait for room
+    instead, only giving up (and counting it as a drop) after ``timeout``."""
+
+    def __init__(self, *, delay=10, concurrency=5, max_pending=200, timeout=30):
+        self.delay = delay
+        self.timeout = timeout
+        self.queues = {}  # user ID -> list of PendingHighlight
+        self._flushes = {}
+        self._room = asyncio.Semaphore(max_pending)
+        self._sending = asyncio.Semaphore(concurrency)
+        self.stats = Counter()
+        self.latencies = deque(maxlen=1000)
+
+    @property
+    def pending(self):
+        return sum(map(len, self.queues.values()))
+
+    def latency(self, percentile):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    async def put(self, pending):
+        try:
+            await asyncio.wait_for(self._room.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["dropped"] += 1
+            log.warning(f"Dropped a highlight for {pending.user.id}, queue is full")
+            return
+        self.stats["queued"] += 1
+        user_id = pending.user.id
+        self.queues.setdefault(user_id, []).append(pending)
+        if user_id not in self._flushes:
+            self._flushes[user_id] = asyncio.ensure_future(self._flush(user_id))
+
+    async def _flush(self, user_id):
+        await asyncio.sleep(self.delay)
+        # Popped together, so hits queued from here on start a new batch
+        del self._flushes[user_id]
+        hits = self.queues.pop(user_id)
+        try:
+            async with self._sending:
+                await self._deliver(hits)
+        finally:
+            for _ in hits:
+                self._room.release()
+
+    async def _deliver(self, hits):
+        content, embed = self.coalesce(hits)
+        try:
+            await hits[0].user.send(content=content, embed=embed)
+        except discord.HTTPException:
+            self.stats["failed"] += len(hits)
+            return
+        now = asyncio.get_event_loop().time()
+        self.latencies.extend(now - hit.queued_at for hit in hits)
+        self.stats["delivered"] += len(hits)
+        self.stats["messages"] += 1
+
+    @staticmethod
+    def coalesce(hits):
+        if len(hits) == 1:
+            return hits[0].text, hits[0].embed
+        embed = discord.Embed(title=f"{len(hits)} new highlights")
+        length = len(embed.title)
+        shown = 0
+        for hit in hits:
+            value = hit.embed.description[-1024:]
+            if "\n" in value and len(hit.embed.description) > 1024:
+                value = value[value.index("\n") + 1 :]  # Don't cut a line short
+            name = hit.embed.title[:256]
+            if shown == 25 or length + len(name) + len(value) > 5900:
+                break
+            embed.add_field(name=name, value=value, inline=False)
+            length += len(name) + len(value)
+            shown += 1
+        if shown < len(hits):
+            embed.set_footer(text=f"+ {len(hits) - shown} more")
+        embed.timestamp = hits[-1].embed.timestamp
+        return hits[-1].text, embed
+
+    def close(self):
+        for task in self._flushes.values():
+            task.cancel()
+
+
+class HighlightContext:
+    """Evaluates whether highlights may be sent for a single message
+
+    Checks which only depend on the message run once, and checks which
+    depend on the recipient run once per user, however many of their
+    highlights were triggered."""
+
+    def __init__(self, message, bot, permissions):
+        self.message = message
+        self.bot = bot
+        self.permissions = permissions
+        self._sendable = None
+        self._users = {}
+
+    @property
+    def sendable(self):
+        if self._sendable is None:
+            message = self.message
+            self._sendable = (
+                message.guild is not None
+                and not message.author.bot
+                and not token_re.search(message.content)
+            )
+        return self._sendable
+
+    async def can_send(self, hl):
+        if not self.sendable:
+            return False
+        if (allowed := self._users.get(hl.user_id)) is None:
+            allowed = self._users[hl.user_id] = await self._check_user(hl.user_id)
+        return allowed
+
+    async def _check_user(self, user_id):
+        message = self.message
+        if user_id == message.author.id:
+            return False
+        if (member := message.guild.get_member(user_id)) is None:
+            return False
+        if settings := await self.bot.user_cache.fetch(user_id):
+            if (wl := settings["hl_whitelist"]) and message.guild.id not in wl:
+                return False
+            if (blocks := settings["hl_blocks"]) and (
+                message.author.id in blocks or message.guild.id in blocks
+            ):
+                return False
+        return self.permissions.can_read(message.channel, member)
+
+
+class PermissionCache:
+    """Remembers whether members can read channels
+
+    Entries are held per guild, then per channel, so that a role, channel or
+    member update can drop exactly the entries it could have affected."""
+
+    def __init__(self):
+        self._guilds = {}  # guild ID -> channel ID -> member ID -> bool
+
+    def can_read(self, channel, member):
+        channels = self._guilds.setdefault(channel.guild.id, {})
+        members = channels.setdefault(channel.id, {})
+        if (allowed := members.get(member.id)) is None:
+            allowed = channel.permissions_for(member).read_messages is not False
+            members[member.id] = allowed
+        return allowed
+
+    def invalidate_guild(self, guild):
+        self._guilds.pop(guild.id, None)
+
+    def invalidate_channel(self, channel):
+        self._guilds.get(channel.guild.id, {}).pop(channel.id, None)
+
+    def invalidate_member(self, member):
+        for members in self._guilds.get(member.guild.id, {}).values():
+            members.pop(member.id, None)
+
+
+class HighlightMatcher:
+    """Finds every highlight triggered by a message
+
+    Plain keywords are all matched in one pass by a KeywordAutomaton. Regex
+    highlights are left to the caller, as they may not be safe to run here."""
+
+    def __init__(self):
+        self.automaton = KeywordAutomaton()
+        self.regexes = {}
+
+    def add(self, hl):
+        if hl.is_regex:
+            self.regexes[hl.key] = hl
+        else:
+            self.automaton.add(hl.kw, hl)
+
+    def remove(self, hl):
+        if hl.is_regex:
+            self.regexes.pop(hl.key, None)
+        else:
+            self.automaton.remove(hl.kw, hl)
+
+    def search(self, content, owners):
+        """Returns a dict of each matching highlight to its first match
+
+        Only plain highlights belonging to ``owners`` are considered"""
+        found = {}
+        for start, end, highlights in self.automaton.search(content):
+            for hl in highlights:
+                if hl not in found and hl.user_id in owners:
+                    found[hl] = content[start:end]
+        return found
+
+    def regexes_for(self, owners):
+        return [hl for hl in self.regexes.values() if hl.user_id in owners]
+
+
 class HlMon(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.cache = []
-        self.queue = []
-        self.recents = {}
+        self.cache = {}  # user ID -> highlights
+        self.matcher = HighlightMatcher()
+        self.owners = set()
+        self.members = {}  # guild ID -> IDs of highlight owners in the guild
+        self.permissions = PermissionCache()
+        self.contexts = ContextProvider(bot)
+        self.dispatcher = HighlightDispatcher()
+        self.recents = ExpiringSet(ttl=60, loop=bot.loop)  # (channel, user) pairs
+        self.sandbox = RegexSandbox(
+            budget=neo.conf.get("highlight_regex_budget") or 0.1,
+            deadline=neo.conf.get("highlight_regex_deadline"),
+        )
+        self.quarantined = set()  # Keys of regex highlights which ran too long
+        self._reloading = asyncio.Lock()
         bot.loop.create_task(self.update_highlight_cache())
-        self.do_highlights.start()
 
     def cog_unload(self):
-        self.do_highlights.cancel()
+        self.dispatcher.close()
+        self.sandbox.close()
 
-    @commands.Cog.listener(name="on_message")
+    @route(guild_only=True)
     async def watch_highlights(self, msg):
-        for hl in self.cache:
-            if hl.user_id in self.recents.get(msg.channel.id, {}):
+        if not (owners := self.members.get(msg.guild.id)):
+            return
+        if msg.author.bot:
+            return
+        context = HighlightContext(msg, self.bot, self.permissions)
+        found = self.matcher.search(msg.content, owners)
+        if regexes := self.matcher.regexes_for(owners):
+            found.update(await self.search_regexes(msg.content, regexes))
+        messages = None
+        for hl, match in found.items():
+            if (msg.channel.id, hl.user_id) in self.recents:
                 continue
-            match = None
-            if m := hl.compiled.search(msg.content):
-                match = m.group(0)
-            if match is None or hl.check_can_send(msg, self.bot) is False:
+            if not await context.can_send(hl):
                 continue
-            if len(self.queue) < 40 and self.queue.count(hl.user_id) < 5:
-                self.queue.append(
-                    PendingHighlight(
-                        self.bot.get_user(hl.user_id),
-                        await hl.to_embed(match, msg, self.bot),
-                        "{0.author}: {0.content}"[:1500].format(msg),
-                    )
+            if messages is None:  # Shared between everyone highlighted
+                messages = await self.contexts.get(msg)
+            if (user := self.bot.get_user(hl.user_id)) is None:
+                continue
+            await self.dispatcher.put(
+                PendingHighlight(
+                    user,
+                    hl.to_embed(match, msg, messages, self.bot),
+                    "{0.author}: {0.content}".format(msg)[:1500],
+                    self.bot.loop.time(),
                 )
+            )
 
-    @commands.Cog.listener(name="on_message")
+    async def search_regexes(self, content, regexes):
+        matches, culprits = await self.sandbox.search(
+            content, [hl.kw for hl in regexes]
+        )
+        for index in culprits:
+            await self.quarantine(regexes[index])
+        return {regexes[index]: match for index, match in matches.items()}
+
+    async def quarantine(self, hl):
+        """Stops matching a regex highlight until the bot restarts"""
+        self.matcher.remove(hl)
+        self.quarantined.add(hl.key)
+        log.warning(f"Quarantined regex highlight {hl.kw!r} of {hl.user_id}")
+        if (user := self.bot.get_user(hl.user_id)) is None:
+            return
+        with suppress(discord.HTTPException):
+            await user.send(
+                f"Your highlight `{shorten(hl.kw, width=175)}` took too long to "
+                "search a message and has been disabled, consider simplifying it"
+            )
+
+    @route(guild_only=True, ignore_bots=True)
     async def update_recents(self, msg):
-        if msg.author.id in {hl.user_id for hl in self.cache}:
-            if not self.recents.get(msg.channel.id):
-                self.recents.update(
-                    {msg.channel.id: TimedSet(decay_time=60, loop=self.bot.loop)}
-                )
-            self.recents[msg.channel.id].add(msg.author.id)
+        if msg.author.id in self.owners:
+            self.recents.add((msg.channel.id, msg.author.id))
 
     @commands.Cog.listener(name="on_hl_update")
-    async def update_highlight_cache(self):
-        await self.bot.wait_until_ready()
-        self.cache = [
-            Highlight(**dict(record))
-            for record in await self.bot.pool.fetch("SELECT * FROM highlights")
-        ]
+    async def update_highlight_cache(self, user_id=None):
+        """Reloads one user's highlights, or everyone's if no user is given
 
-    @tasks.loop(seconds=10)
-    async def do_highlights(self):
-        try:
-            for pending in set(self.queue):
-                with suppress(Exception):
-                    await pending.user.send(content=pending.text, embed=pending.embed)
-                    await asyncio.sleep(0.25)
-        finally:
-            self.queue.clear()
-
-    @do_highlights.before_loop
-    async def wait_for_ready(self):
+        Reloads run one at a time, in the order they were asked for, so an
+        older result can never be installed over a newer one."""
         await self.bot.wait_until_ready()
+        async with self._reloading:
+            await self._reload_highlights(user_id)
+
+    async def _reload_highlights(self, user_id):
+        query = "SELECT user_id, kw, is_regex FROM highlights"
+        if user_id is None:
+            records = await self.bot.pool.fetch(query)
+            affected = {*self.cache, *(record["user_id"] for record in records)}
+        else:
+            records = await self.bot.pool.fetch(query + " WHERE user_id=$1", user_id)
+            affected = {user_id}
+
+        grouped = {user: [] for user in affected}
+        for record in records:
+            grouped[record["user_id"]].append(record)
+        for user, rows in grouped.items():
+            self.replace_highlights(user, rows)
+        self.update_members((self.owners - affected) | (affected & self.cache.keys()))
+
+    def replace_highlights(self, user_id, records):
+        current = {hl.key: hl for hl in self.cache.pop(user_id, ())}
+        highlights = []
+        for record in records:
+            # Highlights which haven't changed are kept, compiled patterns and all
+            if (hl := current.pop(tuple(record), None)) is None:
+                hl = Highlight(**dict(record))
+                if hl.key not in self.quarantined:
+                    self.matcher.add(hl)
+            highlights.append(hl)
+        for hl in current.values():
+            self.matcher.remove(hl)
+        if highlights:
+            self.cache[user_id] = highlights
+
+    @staticmethod
+    def owners_in(guild, owners):
+        if len(owners) < (guild.member_count or 0):
+            return {user_id for user_id in owners if guild.get_member(user_id)}
+        return {m.id for m in guild.members if m.id in owners}
+
+    def update_members(self, owners):
+        """Brings the guild membership index in line with a new set of owners"""
+        added, removed = owners - self.owners, self.owners - owners
+        self.owners = owners
+        for guild in self.bot.guilds:
+            present = self.members.setdefault(guild.id, set())
+            present -= removed
+            present |= self.owners_in(guild, added)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        if member.id in self.owners:
+            self.members.setdefault(member.guild.id, set()).add(member.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        self.members.get(member.guild.id, set()).discard(member.id)
+        self.permissions.invalidate_member(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.permissions.invalidate_member(after)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.members[guild.id] = self.owners_in(guild, self.owners)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.members.pop(guild.id, None)
+        self.permissions.invalidate_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before, after):
+        if before.owner_id != after.owner_id:
+            self.permissions.invalidate_guild(after)
+
+    @commands.Cog.listener("on_guild_role_update")
+    @commands.Cog.listener("on_guild_role_delete")
+    async def invalidate_role_permissions(self, role, *_):
+        self.permissions.invalidate_guild(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if before.overwrites != after.overwrites:
+            self.permissions.invalidate_channel(after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.permissions.invalidate_channel(channel)
 
 
 def index_check(command_input):
@@ -277,14 +600,14 @@ class HighlightCommands(commands.Cog):
             fr"{highlight_words}",
             with_regex,
         )
-        ctx.bot.dispatch("hl_update")
+        ctx.bot.dispatch("hl_update", ctx.author.id)
         await ctx.message.add_reaction(ctx.tick(True))
 
     @commands.command(name="block", aliases=["unblock"])
     async def hl_block(ctx, user_or_guild=None):
         """Block and unblock users and guilds"""
         if not user_or_guild:
-            if b := ctx.bot.user_cache[ctx.author.id]["hl_blocks"]:
+            if b := (await ctx.bot.user_cache.fetch(ctx.author.id))["hl_blocks"]:
                 blocked = [f"{guild_or_user(ctx.bot, i)} ({i})" for i in b]
             else:
                 blocked = ["No blocked users or guilds"]
@@ -297,13 +620,13 @@ class HighlightCommands(commands.Cog):
         except:
             blocked = int(snowflake)
         async with ctx.loading():
-            await ctx.bot.pool.execute(
+            row = await ctx.bot.pool.fetchrow(
                 f"UPDATE user_data SET hl_blocks = {strategy}(hl_blocks, $1) WHERE "
-                "user_id=$2",
+                "user_id=$2 RETURNING *",
                 blocked,
                 ctx.author.id,
             )
-            await ctx.bot.user_cache.refresh()
+            ctx.bot.user_cache.apply(row)
 
     @flags.add_flag("-a", "--add", nargs="*")
     @flags.add_flag("-r", "--remove", nargs="*")
@@ -312,7 +635,7 @@ class HighlightCommands(commands.Cog):
         """Whitelist a guild for highlighting
         This will restrict highlights to only be allowed from guilds on the list"""
         if not flags.get("add") and not flags.get("remove"):
-            if b := ctx.bot.user_cache[ctx.author.id]["hl_whitelist"]:
+            if b := (await ctx.bot.user_cache.fetch(ctx.author.id))["hl_whitelist"]:
                 whitelisted = [f"{ctx.bot.get_guild(i)} ({i})" for i in b]
             else:
                 whitelisted = ["Highlight guild whitelist is empty"]
@@ -321,13 +644,13 @@ class HighlightCommands(commands.Cog):
         strategy = "array_append" if flags.get("add") else "array_remove"
         snowflake = (flags.get("add") or flags.get("remove"))[0]
         async with ctx.loading():
-            await ctx.bot.pool.execute(
+            row = await ctx.bot.pool.fetchrow(
                 f"UPDATE user_data SET hl_whitelist = {strategy}(hl_whitelist, $1) WHERE "
-                "user_id=$2",
+                "user_id=$2 RETURNING *",
                 int(snowflake),
                 ctx.author.id,
             )
-            await ctx.bot.user_cache.refresh()
+            ctx.bot.user_cache.apply(row)
 
     @commands.command(name="remove", aliases=["rm", "delete", "del", "yeet"])
     async def remove_highlight(ctx, highlight_index: commands.Greedy[int]):
@@ -354,7 +677,27 @@ class HighlightCommands(commands.Cog):
                 "\n".join(shown[:5]) + extra
             )
         )
-        ctx.bot.dispatch("hl_update")
+        ctx.bot.dispatch("hl_update", ctx.author.id)
+
+    @commands.command(name="stats")
+    @commands.is_owner()
+    async def hl_stats(ctx):
+        """View highlight delivery metrics"""
+        cog = ctx.bot.get_cog("HlMon")
+        dispatcher, sandbox = cog.dispatcher, cog.sandbox
+        stats = dispatcher.stats
+        embed = discord.Embed(title="Highlight delivery")
+        embed.description = (
+            f"**Queued** {stats['queued']:,d} (**{dispatcher.pending:,d}** pending)\n"
+            f"**Delivered** {stats['delivered']:,d} in {stats['messages']:,d} DMs\n"
+            f"**Failed** {stats['failed']:,d}\n"
+            f"**Dropped** {stats['dropped']:,d}\n"
+            f"**Latency** p50 {dispatcher.latency(50):.2f}s, "
+            f"p99 {dispatcher.latency(99):.2f}s\n"
+            f"**Regex searches skipped** {sandbox.stats['skipped']:,d}, "
+            f"**cut off** {sandbox.stats['cut_off']:,d}"
+        )
+        await ctx.send(embed=embed)
 
     @commands.command(name="clear", aliases=["yeetall"])
     async def clear_highlights(ctx):
@@ -366,7 +709,7 @@ class HighlightCommands(commands.Cog):
             await ctx.bot.pool.execute(
                 "DELETE FROM highlights WHERE user_id=$1", ctx.author.id
             )
-            ctx.bot.dispatch("hl_update")
+            ctx.bot.dispatch("hl_update", ctx.author.id)
 
 
 def setup(bot):
@@ -1,13 +1,23 @@
 import asyncio
+import heapq
 import textwrap
-from datetime import datetime
+from contextlib import suppress
+from datetime import datetime, timedelta
+from operator import attrgetter
 from typing import Union
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 
 MEDALS = ("🥇", "🥈", "🥉", "\n4", "5")
+FLUSH_DELAY = 5  # Seconds a star's count is left to settle before it's written
+by_stars = attrgetter("stars")
+
+
+def is_expired(message_id, max_days):
+    """Whether a message is too old for its stars to change"""
+    return (datetime.utcnow() - discord.Object(message_id).created_at).days > max_days
 
 
 class Star:
@@ -15,6 +25,7 @@ class Star:
         self.original_id = original_id
         self.referencing_message = referencing_message
         self.stars = stars
+        self.flushed = stars  # The count last written to Discord and the DB
 
     def __repr__(self):
         return (
@@ -24,6 +35,7 @@ class Star:
 
     def to_composite_castable(self):
         copy = vars(self).copy()
+        del copy["flushed"]
         copy.update(referencing_message=self.referencing_message.id)
         return copy
 
@@ -31,6 +43,41 @@ class Star:
         await self.referencing_message.edit(**kwargs)
 
 
+def star_count(message):
+    return getattr(
+        discord.utils.get(message.reactions, emoji="\N{WHITE MEDIUM STAR}"),
+        "count",
+        0,
+    )
+
+
+class PendingStars:
+    """Star counts of messages which haven't made it onto a starboard
+
+    Messages which couldn't be fetched are held as None so that they aren't
+    fetched again. Past ``max_size`` messages, the least recently changed
+    are dropped, to be seeded again if they get another star."""
+
+    def __init__(self, max_size=10_000):
+        self.max_size = max_size
+        self._counts = {}
+
+    def __contains__(self, message_id):
+        return message_id in self._counts
+
+    def get(self, message_id):
+        return self._counts.get(message_id)
+
+    def set(self, message_id, count):
+        self._counts.pop(message_id, None)
+        self._counts[message_id] = count
+        if len(self._counts) > self.max_size:
+            del self._counts[next(iter(self._counts))]
+
+    def discard(self, message_id):
+        self._counts.pop(message_id, None)
+
+
 class Starboard:
     def __init__(
         self, *, channel: discord.TextChannel, stars, format, required_stars, max_days
@@ -39,7 +86,9 @@ class Starboard:
         self.required_stars = required_stars
         self.max_days = max_days
         self._stars = stars
-        self._cached_stars = {}
+        self._cached_stars = {}  # Only stars which can still change are held
+        self._top = []  # The highest starred of those, most stars first
+        self._archive = None  # The highest starred of the rest, loaded on demand
         self._format = format
         self._ready = False
 
@@ -62,6 +111,8 @@ class Starboard:
                 original_id=star["message_id"],
             )
 
+        del self._stars
+        self._rebuild_top()
         self._ready = True
         return self
 
@@ -69,6 +120,57 @@ class Starboard:
     def stars(self):
         return self._cached_stars
 
+    @property
+    def top(self):
+        return self._top
+
+    def hold(self, record):
+        """Holds a star stored in the database, unless it's held already"""
+        if (star := self.get_star(record["message_id"])) is None:
+            star = self._cached_stars[record["message_id"]] = Star(
+                referencing_message=self.channel.get_partial_message(
+                    record["starred_message_id"]
+                ),
+                stars=record["stars"],
+                original_id=record["message_id"],
+            )
+            self.rank(star, star.stars)
+        return star
+
+    def _rebuild_top(self):
+        self._top = heapq.nlargest(
+            len(MEDALS), self._cached_stars.values(), key=by_stars
+        )
+
+    def rank(self, star, previous):
+        """Keeps the top stars in line with a change to a star's count"""
+        top = self._top
+        if star in top:
+            top.sort(key=by_stars, reverse=True)
+            # Only a star which fell to the bottom could be overtaken by another
+            if star.stars < previous and star is top[-1]:
+                self._rebuild_top()
+        elif len(top) < len(MEDALS) or star.stars > top[-1].stars:
+            top.append(star)
+            top.sort(key=by_stars, reverse=True)
+            del top[len(MEDALS) :]
+
+    def evict(self):
+        """Drops stars which are too old to change, returning how many
+
+        Stars with a count yet to be written out are left for the next round."""
+        expired = [
+            id
+            for id, star in self._cached_stars.items()
+            if star.stars == star.flushed and is_expired(id, self.max_days)
+        ]
+        for id in expired:
+            del self._cached_stars[id]
+        if expired:
+            self._archive = None  # They may belong in it now
+            self._rebuild_top()
+        return len(expired)
+
     def get_star(self, id):
         return self._cached_stars.get(id)
 
@@ -108,6 +210,7 @@ class Starboard:
 
         star = Star(**kwargs)
         self._cached_stars[star.original_id] = star
+        self.rank(star, stars)
         return star
 
     async def destroy_star(self, id):
@@ -115,6 +218,8 @@ class Starboard:
             return
 
         star = self._cached_stars.pop(id)
+        if star in self._top:
+            self._rebuild_top()
         try:
             await star.referencing_message.delete()
         finally:
@@ -138,25 +243,86 @@ class StarboardCog(commands.Cog, name="Starboard"):
         self.bot = bot
         self._ready = False
         self.starboards = {}
+        self._flushes = {}  # message ID -> task writing out its star count
+        self.pending = PendingStars()
+        self._promoting = set()  # IDs of pending messages being starred
         bot.loop.create_task(self.__ainit__())
+        self.evict_stars.start()
+
+    def cog_unload(self):
+        self.evict_stars.cancel()
+        for task in [*self._flushes.values()]:
+            task.cancel()
+        # Counts which haven't been written yet would be lost otherwise
+        unflushed = [
+            (starboard, star)
+            for starboard in self.starboards.values()
+            for star in starboard.stars.values()
+            if star.stars != star.flushed
+        ]
+        if unflushed:
+            self.bot.loop.create_task(self.write_out(unflushed))
+
+    async def write_out(self, unflushed):
+        """Writes every given star's count at once, without waiting to settle
+
+        Stars which fell below their starboard's requirement are removed."""
+        fallen = [
+            (starboard, star)
+            for starboard, star in unflushed
+            if star.stars < starboard.required_stars
+        ]
+        unflushed = [pair for pair in unflushed if pair not in fallen]
+        if fallen:
+            query = "DELETE FROM starboard_msgs WHERE message_id = ANY($1::BIGINT[])"
+            await self.bot.pool.execute(query, [star.original_id for _, star in fallen])
+        if unflushed:
+            query = """
+            UPDATE starboard_msgs
+            SET stars = counts.stars
+            FROM unnest($1::BIGINT[], $2::BIGINT[]) AS counts (message_id, stars)
+            WHERE starboard_msgs.message_id = counts.message_id
+            """
+            await self.bot.pool.execute(
+                query,
+                [star.original_id for _, star in unflushed],
+                [star.stars for _, star in unflushed],
+            )
+        for starboard, star in fallen:
+            await starboard.destroy_star(star.original_id)  # Ignores failures
+        for starboard, star in unflushed:
+            star.flushed = star.stars
+            with suppress(discord.HTTPException):  # The bot may be closing
+                await star.edit(content=starboard._format.format(stars=star.stars))
 
     async def __ainit__(self):
         await self.bot.wait_until_ready()
 
-        for guild, config in self.bot.guild_cache.items():
-            if not config.get("starboard_channel_id"):
-                continue
-
-            query = """
-            SELECT message_id, stars, starred_message_id
-            FROM starboard_msgs
-            WHERE guild_id = $1
-            """
+        configs = {
+            guild: config
+            for guild, config in self.bot.guild_cache.items()
+            if config.get("starboard_channel_id")
+        }
+        # One query for every starboard, rather than one per guild. Stars too
+        # old to change are left in the database for the leaderboard to find.
+        query = """
+        SELECT guild_id, message_id, stars, starred_message_id
+        FROM starboard_msgs
+        JOIN guild_prefs USING (guild_id)
+        WHERE guild_id = ANY($1::BIGINT[])
+        AND message_id >= ((
+            EXTRACT(EPOCH FROM now() - (starboard_max_days + 1) * INTERVAL '1 day')
+            * 1000 - 1420070400000
+        )::BIGINT << 22)
+        """
+        starred_messages = {guild: [] for guild in configs}
+        for record in await self.bot.pool.fetch(query, list(configs)):
+            starred_messages[record["guild_id"]].append(record)
 
-            starred_messages = await self.bot.pool.fetch(query, guild)
+        for guild, config in configs.items():
             kwargs = {
                 "channel": self.bot.get_channel(config["starboard_channel_id"]),
-                "stars": starred_messages,
+                "stars": starred_messages[guild],
                 "format": config["starboard_format"],
                 "required_stars": config["starboard_star_requirement"],
                 "max_days": config["starboard_max_days"],
@@ -168,15 +334,107 @@ class StarboardCog(commands.Cog, name="Starboard"):
 
         self._ready = True
 
-    async def get_message(self, channel, message_id):
-        message = await channel.history(
-            limit=1, before=discord.Object(message_id + 1)
-        ).next()
-        return message
+    @tasks.loop(hours=1)
+    async def evict_stars(self):
+        for starboard in self.starboards.values():
+            if starboard._ready:
+                starboard.evict()
+
+    @evict_stars.before_loop
+    async def wait_for_starboards(self):
+        await self.bot.wait_until_ready()
+
+    async def archived_top(self, guild_id, starboard):
+        """The highest starred messages too old to be held in memory"""
+        if starboard._archive is None:
+            cutoff = datetime.utcnow() - timedelta(days=starboard.max_days + 1)
+            query = """
+            SELECT message_id, stars, starred_message_id
+            FROM starboard_msgs
+            WHERE guild_id = $1 AND message_id < $2
+            ORDER BY stars DESC
+            LIMIT $3
+            """
+            records = await self.bot.pool.fetch(
+                query, guild_id, discord.utils.time_snowflake(cutoff), len(MEDALS)
+            )
+            starboard._archive = [
+                Star(
+                    referencing_message=starboard.channel.get_partial_message(
+                        record["starred_message_id"]
+                    ),
+                    stars=record["stars"],
+                    original_id=record["message_id"],
+                )
+                for record in records
+            ]
+        return starboard._archive
+
+    async def reopen(self, guild_id, starboard, previous):
+        """Holds the stars brought back within max_days by raising it"""
+        now = datetime.utcnow()
+        query = """
+        SELECT message_id, stars, starred_message_id
+        FROM starboard_msgs
+        WHERE guild_id = $1 AND message_id >= $2 AND message_id < $3
+        """
+        opened = now - timedelta(days=starboard.max_days + 1)
+        closed = now - timedelta(days=previous + 1)
+        records = await self.bot.pool.fetch(
+            query,
+            guild_id,
+            discord.utils.time_snowflake(opened),
+            discord.utils.time_snowflake(closed, high=True),
+        )
+        for record in records:
+            starboard.hold(record)
+
+    async def get_message(self, payload):
+        # The gateway's message cache saves an API call for recent messages
+        if message := self.bot._connection._get_message(payload.message_id):
+            return message
+        if (channel := self.bot.get_channel(payload.channel_id)) is None:
+            return None
+        try:
+            return await channel.fetch_message(payload.message_id)
+        except discord.HTTPException:
+            return None
 
     def reaction_check(self, payload):
         return str(payload.emoji) == "⭐"
 
+    def schedule_flush(self, starboard, star):
+        if star.original_id not in self._flushes:
+            self._flushes[star.original_id] = self.bot.loop.create_task(
+                self.flush_star(starboard, star)
+            )
+
+    async def flush_star(self, starboard, star):
+        """Writes out a star's count once changes to it have settled
+
+        Changes made while a write is in flight are picked up by another
+        round, so the starboard always ends up showing the latest count."""
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_DELAY)
+                if (stars := star.stars) == star.flushed:
+                    return
+                if stars < starboard.required_stars:
+                    await starboard.destroy_star(star.original_id)
+                    query = "DELETE FROM starboard_msgs WHERE message_id = $1"
+                    await self.bot.pool.execute(query, star.original_id)
+                    return
+                await starboard.update_star(star.original_id, stars)
+                query = """
+                UPDATE starboard_msgs
+                SET stars = $1
+                WHERE message_id = $2
+                """
+                await self.bot.pool.execute(query, stars, star.original_id)
+                star.flushed = stars
+        finally:
+            self._flushes.pop(star.original_id, None)
+
     @commands.Cog.listener("on_raw_reaction_add")
     @commands.Cog.listener("on_raw_reaction_remove")
     @commands.Cog.listener("on_raw_reaction_clear")
@@ -191,82 +449,138 @@ class StarboardCog(commands.Cog, name="Starboard"):
             return
         if payload.channel_id == starboard.channel.id:
             return
-        if (
-            datetime.utcnow() - discord.Object(payload.message_id).created_at
-        ).days > starboard.max_days:
+        if is_expired(payload.message_id, starboard.max_days):
             return
 
         if (star := starboard.get_star(payload.message_id)) is None:
+            await self.track_pending(starboard, payload)
+            return
 
-            message = await self.get_message(
-                self.bot.get_channel(payload.channel_id), payload.message_id
-            )
+        if (stars := self.apply_event(payload, star.stars)) is None:
+            return
+        previous, star.stars = star.stars, stars
+        starboard.rank(star, previous)
+        self.schedule_flush(starboard, star)
+
+    async def track_pending(self, starboard, payload):
+        """Counts stars on a message which isn't on the starboard yet
+
+        The message is only fetched to seed its count, which is kept up to
+        date from events after that, and again once it looks to have enough
+        stars, as the message itself is needed to create the star."""
+        message_id = payload.message_id
+        if isinstance(payload, discord.RawMessageDeleteEvent):
+            self.pending.discard(message_id)
+            return
 
-            count = getattr(
-                discord.utils.get(message.reactions, emoji="\N{WHITE MEDIUM STAR}"),
-                "count",
-                0,
-            )
-            if count < starboard.required_stars:
+        message = None
+        if message_id in self.pending:
+            if (count := self.pending.get(message_id)) is None:
+                return  # Couldn't be fetched before, don't keep trying
+            if (count := self.apply_event(payload, count)) is None:
+                return
+        elif isinstance(payload, discord.RawReactionActionEvent):
+            if not self.reaction_check(payload):
                 return
+            # Both the cached and the fetched message already include this event
+            if (message := await self.get_message(payload)) is not None:
+                count = star_count(message)
+            else:
+                count = None
+        elif (count := self.apply_event(payload, 0)) is None:
+            return
 
-            star = await starboard.create_star(message, count)
+        self.pending.set(message_id, count)
+        if count is None or count < starboard.required_stars:
+            return
+        if message_id in self._promoting:
+            return  # The count is picked up by the event already starring it
+        self._promoting.add(message_id)
+        try:
+            await self.promote(starboard, payload, message)
+        finally:
+            self._promoting.discard(message_id)
 
-            if not star:
-                return
+    async def promote(self, starboard, payload, message=None):
+        """Puts a pending message on the starboard
 
-            query = """
-            INSERT INTO starboard_msgs (
-                message_id, 
-                channel_id, 
-                guild_id, 
-                stars, 
-                starred_message_id
-            )
-            VALUES ($1,$2,$3,$4,$5)
-            """
-            arguments = (
-                message.id,
-                message.channel.id,
-                message.guild.id,
-                count,
-                star.referencing_message.id,
-            )
-            await self.bot.pool.execute(query, *arguments)
+        It stays pending until its star is held, so that events in the
+        meantime still count towards it, rather than starring it again."""
+        message_id = payload.message_id
+        if message is None:
+            if (message := await self.get_message(payload)) is None:
+                self.pending.set(message_id, None)
+                return
+            count = star_count(message)
+            self.pending.set(message_id, count)
+            if count < starboard.required_stars:
+                return  # The estimate was off
 
-        else:
+        query = """
+        SELECT message_id, stars, starred_message_id
+        FROM starboard_msgs
+        WHERE message_id = $1 AND guild_id = $2
+        """
+        record = await self.bot.pool.fetchrow(query, message_id, message.guild.id)
+        if (count := self.pending.get(message_id)) is None:
+            return  # Deleted, or dropped from the pending stars meanwhile
+        if record:
+            # It's been starred already, but wasn't held, so it keeps its post
+            self.pending.discard(message_id)
+            star = starboard.hold(record)
+            previous, star.stars = star.stars, count
+            starboard.rank(star, previous)
+            self.schedule_flush(starboard, star)
+            return
 
-            if isinstance(payload, discord.RawReactionActionEvent):
-                if not self.reaction_check(payload):
-                    return
+        star = await starboard.create_star(message, count)
+        latest = self.pending.get(message_id)
+        self.pending.discard(message_id)
+        if not star:
+            return
+        if latest is not None and latest != star.stars:
+            # Changed while it was being posted, so the post is out of date
+            previous, star.stars = star.stars, latest
+            starboard.rank(star, previous)
+            self.schedule_flush(starboard, star)
 
-                if payload.event_type == "REACTION_ADD":
-                    star.stars += 1
-                else:
-                    star.stars -= 1
+        query = """
+        INSERT INTO starboard_msgs (
+            message_id, 
+            channel_id, 
+            guild_id, 
+            stars, 
+            starred_message_id
+        )
+        VALUES ($1,$2,$3,$4,$5)
+        ON CONFLICT (message_id, channel_id, guild_id) DO UPDATE
+        SET stars = EXCLUDED.stars, starred_message_id = EXCLUDED.starred_message_id
+        """
+        arguments = (
+            message.id,
+            message.channel.id,
+            message.guild.id,
+            count,
+            star.referencing_message.id,
+        )
+        await self.bot.pool.execute(query, *arguments)
 
-            elif isinstance(payload, discord.RawReactionClearEmojiEvent):
-                if not self.reaction_check(payload):
-                    return
-                star.stars = 0
+    def apply_event(self, payload, stars):
+        """Returns the star count after an event, or None if it doesn't affect it"""
+        if isinstance(payload, discord.RawReactionActionEvent):
+            if not self.reaction_check(payload):
+                return None
+            if payload.event_type == "REACTION_ADD":
+                return stars + 1
+            return stars - 1
 
-            elif isinstance(
-                payload, (discord.RawReactionClearEvent, discord.RawMessageDeleteEvent)
-            ):
-                star.stars = 0
+        elif isinstance(payload, discord.RawReactionClearEmojiEvent):
+            if not self.reaction_check(payload):
+                return None
+            return 0
 
-            if star.stars < starboard.required_stars:
-                await starboard.destroy_star(star.original_id)
-                query = "DELETE FROM starboard_msgs WHERE message_id = $1"
-                await self.bot.pool.execute(query, star.original_id)
-            else:
-                await starboard.update_star(star.original_id, star.stars)
-                query = """
-                UPDATE starboard_msgs
-                SET stars = $1
-                WHERE message_id = $2
-                """
-                await self.bot.pool.execute(query, star.stars, star.original_id)
+        # Every reaction was cleared, or the message was deleted
+        return 0
 
     @commands.group(invoke_without_command=True)
     @commands.guild_only()
@@ -301,9 +615,10 @@ class StarboardCog(commands.Cog, name="Starboard"):
 
         embed = discord.Embed(title=f"{ctx.guild} Starboard Leaderboard", description="")
 
-        top_stars = sorted(
-            starboard.stars.values(), key=lambda star: star.stars, reverse=True
-        )
+        # Held stars take precedence, the archive may be behind on their counts
+        archived = await self.archived_top(ctx.guild.id, starboard)
+        candidates = {star.original_id: star for star in (*archived, *starboard.top)}
+        top_stars = heapq.nlargest(len(MEDALS), candidates.values(), key=by_stars)
 
         for index, star in enumerate(top_stars):
             try:
@@ -355,7 +670,7 @@ class StarboardCog(commands.Cog, name="Starboard"):
             max_days=row["starboard_max_days"],
         )
         self.starboards[ctx.guild.id] = starboard
-        self.bot.guild_cache[ctx.guild.id].update(dict(row))
+        self.bot.guild_cache.apply(row)
         await ctx.send(
             f"Created starboard which resides at {starboard.channel.mention}"
         )
@@ -411,7 +726,7 @@ class StarboardCog(commands.Cog, name="Starboard"):
         RETURNING *;
         """
         ret = await self.bot.pool.fetchrow(query.format(key), value, ctx.guild.id)
-        self.bot.guild_cache[ctx.guild.id] = dict(ret)
+        self.bot.guild_cache.apply(ret)
 
         starboard = self.starboards[ctx.guild.id]
         if key == "star_requirement":
@@ -420,7 +735,12 @@ class StarboardCog(commands.Cog, name="Starboard"):
         elif key == "format":
             starboard._format = value
         elif key == "max_days":
-            starboard.max_days = value
+            previous, starboard.max_days = starboard.max_days, value
+            starboard._archive = None
+            if value > previous:
+                await self.reopen(ctx.guild.id, starboard, previous)
+            else:
+                starboard.evict()
 
         await ctx.send(f"Setting `{key}` successfully changed to `{value}`")
 
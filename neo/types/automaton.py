@@ -0,0 +1,176 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+__all__ = ("KeywordAutomaton",)
+
+
+def fold(text):
+    """Case folds text without changing its length, mirroring re.I"""
+    folded = text.lower()
+    if len(folded) != len(text):
+        # A few characters lower to more than one, leave those untouched
+        folded = "".join(
+            lowered if len(lowered := char.lower()) == 1 else char for char in text
+        )
+    return folded.replace("ς", "σ")
+
+
+def is_word(char):
+    return char.isalnum() or char == "_"
+
+
+class KeywordAutomaton:
+    """An Aho-Corasick automaton matching keywords as ``\\b{kw}\\b`` with re.I
+
+    Keywords can be added and removed at any time. Failure and output links
+    are computed lazily as states are visited, and simply forgotten when the
+    trie changes, so an edit costs O(len(keyword)) instead of a rebuild."""
+
+    def __init__(self):
+        self._children = [{}]
+        self._parent = [0]
+        self._char = [""]
+        self._depth = [0]
+        self._values = {}  # terminal node -> values added for that keyword
+        self._live_chars = 0
+        self._forget_links()
+
+    def __len__(self):
+        return len(self._values)
+
+    def _forget_links(self):
+        self._fails = {0: 0}
+        self._outputs = {0: ()}
+
+    def add(self, keyword, value):
+        node = 0
+        for char in fold(keyword):
+            if (child := self._children[node].get(char)) is None:
+                child = len(self._children)
+                self._children.append({})
+                self._parent.append(node)
+                self._char.append(char)
+                self._depth.append(self._depth[node] + 1)
+                self._children[node][char] = child
+                self._forget_links()  # New states can change existing links
+            node = child
+        if node not in self._values:
+            self._values[node] = set()
+            self._live_chars += len(keyword)
+            self._outputs = {0: ()}
+        self._values[node].add(value)
+
+    def remove(self, keyword, value):
+        node = 0
+        for char in fold(keyword):
+            if (node := self._children[node].get(char)) is None:
+                return
+        if (values := self._values.get(node)) is None:
+            return
+        values.discard(value)
+        if not values:
+            del self._values[node]
+            self._live_chars -= len(keyword)
+            self._outputs = {0: ()}
+            if len(self._children) > 2 * self._live_chars + 1024:
+                self._compact()
+
+    def _compact(self):
+        """Rebuilds the trie without the states left behind by removals"""
+        live = {}
+        for node, values in self._values.items():
+            chars = []
+            while node:
+                chars.append(self._char[node])
+                node = self._parent[node]
+            live["".join(reversed(chars))] = values
+        self.__init__()
+        for keyword, values in live.items():
+            for value in values:
+                self.add(keyword, value)
+
+    def _fail(self, node):
+        fails = self._fails
+        pending = [node]
+        while pending:
+            state = pending[-1]
+            if state in fails:
+                pending.pop()
+                continue
+            parent = self._parent[state]
+            if parent == 0:
+                fails[state] = 0
+                continue
+            if parent not in fails:
+                pending.append(parent)
+                continue
+            char = self._char[state]
+            fallback = fails[parent]
+            while True:
+                if (child := self._children[fallback].get(char)) is not None:
+                    fails[state] = child
+                    break
+                if fallback == 0:
+                    fails[state] = 0
+                    break
+                if fallback not in fails:
+                    # Needs a shallower link first, this state is retried after
+                    pending.append(fallback)
+                    break
+                fallback = fails[fallback]
+        return fails[node]
+
+    def _output(self, node):
+        outputs = self._outputs
+        pending = [node]
+        while pending:
+            state = pending[-1]
+            if state in outputs:
+                pending.pop()
+                continue
+            fail = self._fail(state)
+            if fail not in outputs:
+                pending.append(fail)
+                continue
+            own = (state,) if state in self._values else ()
+            outputs[state] = own + outputs[fail]
+        return outputs[node]
+
+    def search(self, text):
+        """Yields ``(start, end, values)`` for every match, ordered by end"""
+        if not self._values:
+            return
+        children = self._children
+        state = 0
+        for index, char in enumerate(fold(text)):
+            while state and char not in children[state]:
+                state = self._fail(state)
+            state = children[state].get(char, 0)
+            if not state:
+                continue
+            for terminal in self._output(state):
+                end = index + 1
+                start = end - self._depth[terminal]
+                if self._bounded(text, start, end):
+                    yield start, end, self._values[terminal]
+
+    @staticmethod
+    def _bounded(text, start, end):
+        before = start > 0 and is_word(text[start - 1])
+        after = end < len(text) and is_word(text[end])
+        return before != is_word(text[start]) and is_word(text[end - 1]) != after
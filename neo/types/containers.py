@@ -16,56 +16,299 @@ You should have received a copy of the GNU Affero General Public License
 along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
-from collections import namedtuple, defaultdict
-from contextlib import suppress
+import json
+from collections import defaultdict
+from collections.abc import MutableMapping, MutableSet
 
-__all__ = ("TimedSet", "DbCache")
+__all__ = ("ExpiringMap", "ExpiringSet", "Row", "DbCache", "LazyDbCache")
 
-PendingValue = namedtuple("PendingValue", "item task")
+class ExpiringMap(MutableMapping):
+    """A mapping whose keys expire ``ttl`` seconds after they were last set
 
+    As every key lives for the same ttl, keys are simply kept in expiry
+    order: setting moves a key to the end and expiry pops from the front.
+    One task per map sleeps until the oldest key is due, then sweeps every
+    key due within ``resolution`` seconds of it in bulk."""
 
-class TimedSet(set):
-    def __init__(self, *args, decay_time, loop=None, **kwargs):
-        self.decay_time = decay_time
+    def __init__(self, *, ttl, resolution=1, loop=None):
+        self.ttl = ttl
+        self.resolution = resolution
         self.loop = loop or asyncio.get_event_loop()
-        self.running = {}
-        super().__init__(*args, **kwargs)
-        for item in self:
+        self._data = {}  # key -> (deadline, value)
+        self._sweeper = None
+
+    def __getitem__(self, key):
+        deadline, value = self._data[key]
+        if deadline <= self.loop.time():  # Due, but not swept yet
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (self.loop.time() + self.ttl, value)
+        if self._sweeper is None:
+            self._sweeper = self.loop.create_task(self._sweep())
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        now = self.loop.time()
+        return iter([k for k, (deadline, _) in self._data.items() if deadline > now])
+
+    def __len__(self):
+        self.expire()
+        return len(self._data)
+
+    def touch(self, key):
+        self[key] = self[key]
+
+    def expire(self, until=None):
+        until = self.loop.time() if until is None else until
+        data = self._data
+        while data:
+            key = next(iter(data))
+            if data[key][0] > until:
+                break
+            del data[key]
+
+    async def _sweep(self):
+        try:
+            while self._data:
+                deadline = self._data[next(iter(self._data))][0]
+                await asyncio.sleep(max(0, deadline - self.loop.time()))
+                self.expire(self.loop.time() + self.resolution)
+        finally:
+            self._sweeper = None
+
+
+class ExpiringSet(MutableSet):
+    """A set whose items expire ``ttl`` seconds after they were last added"""
+
+    def __init__(self, *args, ttl, resolution=1, loop=None):
+        self._items = ExpiringMap(ttl=ttl, resolution=resolution, loop=loop)
+        for item in args and args[0]:
             self.add(item)
 
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
     def add(self, item):
-        with suppress(KeyError):
-            if con := self.running.pop(item):
-                con.task.cancel()
-                self.discard(item)
-        super().add(item)
-        task = self.loop.create_task(self.decay(item))
-        self.running[item] = PendingValue(item, task)
+        self._items[item] = None
 
-    async def decay(self, item):
-        await asyncio.sleep(self.decay_time)
-        self.discard(item)
+    def discard(self, item):
+        self._items.pop(item, None)
+
+
+class Row(MutableMapping):
+    """A slotted mapping over a fixed set of columns
+
+    Create a row type for a set of columns with ``Row.of``. Arrays are stored
+    as tuples, which lets every empty array share the same empty tuple."""
+
+    __slots__ = ()
+    _columns = frozenset()
+
+    @classmethod
+    def of(cls, columns):
+        return type(
+            cls.__name__, (cls,), {"__slots__": columns, "_columns": frozenset(columns)}
+        )
+
+    def __init__(self, record=None):
+        for column in self.__slots__:
+            value = record.get(column) if record is not None else None
+            object.__setattr__(self, column, self._compact(value))
+
+    @staticmethod
+    def _compact(value):
+        return tuple(value) if isinstance(value, list) else value
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            raise KeyError(column)
+        return getattr(self, column)
+
+    def __setitem__(self, column, value):
+        if column not in self._columns:
+            raise KeyError(column)
+        object.__setattr__(self, column, self._compact(value))
+
+    def __delitem__(self, column):
+        raise TypeError(f"{self.__class__.__name__} columns can't be deleted")
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        attrs = " ".join(f"{k}={v!r}" for k, v in self.items())
+        return f"<{self.__class__.__name__} {attrs}>"
 
 
 class DbCache(defaultdict):
-    def __init__(self, *, db_query, query_params=[], pool, key):
+    def __init__(self, *, table, key, pool, columns=None):
+        self.row_type = Row.of(tuple(columns)) if columns else None
+        # Missing keys still default to an empty, falsy dict rather than a row
         super().__init__(dict)
         self.pool = pool
-        self.db_query = db_query
-        self.query_params = query_params
+        self.table = table
         self.key = key
+        # Only fetch the columns that rows actually hold
+        self._selected = ", ".join((key, *columns)) if columns else "*"
+        self._refetching = {}
+        self._stale = set()
 
     def __await__(self):
         return self._build_cache().__await__()
 
+    def _fetch_all(self):
+        return self.pool.fetch(f"SELECT {self._selected} FROM {self.table}")
+
     async def _build_cache(self):
-        data = await self.pool.fetch(self.db_query, *self.query_params)
-        for record in data:
-            copied = dict(record)
-            self[copied.pop(self.key)] = copied
+        for record in await self._fetch_all():
+            self.apply(record)
         return self
 
     async def refresh(self):
+        """Reloads every row, swapping the old ones out only once it's done"""
+        records = await self._fetch_all()
         self.clear()
-        await self._build_cache()
+        for record in records:
+            self.apply(record)
         return self
+
+    def apply(self, record):
+        """Stores a row fetched from the table, replacing any cached copy"""
+        if self.row_type is not None:
+            row = self[record[self.key]] = self.row_type(record)
+            return row
+        copied = dict(record)
+        self[copied.pop(self.key)] = copied
+        return copied
+
+    def invalidate(self, key):
+        """Drops a single key from the cache"""
+        return self.pop(key, None)
+
+    async def fetch(self, key):
+        """Gets a row, fetching it first if this cache doesn't hold it"""
+        return self.get(key)
+
+    def _fetch_row(self, key):
+        return self.pool.fetchrow(
+            f"SELECT {self._selected} FROM {self.table} WHERE {self.key}=$1", key
+        )
+
+    async def upsert(self, key):
+        """Refetches a single row, dropping it if it no longer exists"""
+        record = await self._fetch_row(key)
+        if record is None:
+            self.invalidate(key)
+            return None
+        return self.apply(record)
+
+    @property
+    def channel(self):
+        return f"{self.table}_changes"
+
+    async def listen(self, connection):
+        """Keeps this cache coherent with the table's change notifications
+
+        The connection must be dedicated to listening, as it is held for as
+        long as the subscription is active. See ``notify_cache_change`` in
+        the schema for the trigger which emits the payloads."""
+        await connection.add_listener(self.channel, self._on_notification)
+
+    async def unlisten(self, connection):
+        await connection.remove_listener(self.channel, self._on_notification)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self._changed(json.loads(payload)["key"])
+
+    def _changed(self, key):
+        if key in self._refetching:
+            # A fetch is already in flight and may predate this change
+            self._stale.add(key)
+            return
+        self._refetching[key] = asyncio.ensure_future(self._refetch(key))
+
+    async def _refetch(self, key):
+        try:
+            await self.upsert(key)
+            while key in self._stale:
+                self._stale.discard(key)
+                await self.upsert(key)
+        finally:
+            self._refetching.pop(key, None)
+
+
+class LazyDbCache(DbCache):
+    """A DbCache which holds only the most recently used rows
+
+    Nothing is loaded up front, rows are fetched on first access via
+    ``fetch`` and the least recently used are evicted past ``max_size``.
+    Keys without a row are cached too, as ``None``, so repeated lookups of
+    them don't hit the database."""
+
+    def __init__(self, *, max_size, **kwargs):
+        super().__init__(**kwargs)
+        self.max_size = max_size
+        self._loading = {}
+
+    async def _fetch_all(self):
+        return ()  # Rows are loaded on demand, so refreshing just drops them
+
+    async def _build_cache(self):
+        return self
+
+    def __missing__(self, key):
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if (value := self.get(key)) is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        dict.pop(self, key, None)
+        super().__setitem__(key, value)
+        while len(self) > self.max_size:
+            dict.pop(self, next(iter(self)))
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        # Reinserting moves the key to the most recently used end
+        value = dict.pop(self, key)
+        dict.__setitem__(self, key, value)
+        return default if value is None else value
+
+    async def fetch(self, key):
+        if key in self:
+            return self.get(key)
+        if (pending := self._loading.get(key)) is None:
+            # Concurrent misses for the same key all wait on one query
+            pending = self._loading[key] = asyncio.ensure_future(self._load(key))
+        return await asyncio.shield(pending)
+
+    async def _load(self, key):
+        try:
+            if (record := await self._fetch_row(key)) is None:
+                self[key] = None
+                return None
+            return self.apply(record)
+        finally:
+            self._loading.pop(key, None)
+
+    def _changed(self, key):
+        if key in self:  # Rows which aren't held are fetched fresh anyway
+            super()._changed(key)
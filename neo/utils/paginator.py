@@ -17,12 +17,13 @@ along with neo.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
 import contextlib
+import math
 
 import discord
 import neo
 from discord.ext import menus
 
-__all__ = ("CSMenu", "BareBonesMenu", "PagedEmbedMenu", "paginate")
+__all__ = ("CSMenu", "BareBonesMenu", "PagedEmbedMenu", "KeysetPageSource", "paginate")
 
 
 class CSMenu(menus.MenuPages, inherit_buttons=False):
@@ -212,6 +213,57 @@ class BareBonesMenu(menus.ListPageSource):
             return discord.Embed(description=join_str.join(page))
 
 
+class KeysetPageSource(menus.PageSource):
+    """A page source which loads each page only once it's shown
+
+    ``fetch(after, skip, limit)`` returns up to ``limit`` entries in key
+    order, skipping ``skip`` entries after the one keyed ``after``, or from
+    the start if that's None. ``key`` gives an entry's key, and
+    ``format_entry(index, entry)`` its line on the page. Pages are fetched
+    from the nearest page boundary already seen, so paging through in order
+    never reads the entries before the page."""
+
+    def __init__(
+        self, fetch, *, count, per_page, key, format_entry, embed=None, cached=5
+    ):
+        self.fetch = fetch
+        self.count = count
+        self.per_page = per_page
+        self.key = key
+        self.format_entry = format_entry
+        self.embed = embed
+        self.cached = cached
+        self._after = {0: None}  # page number -> key of the last entry before it
+        self._pages = {}  # page number -> entries, least recently shown first
+
+    def is_paginating(self):
+        return self.count > self.per_page
+
+    def get_max_pages(self):
+        return max(1, math.ceil(self.count / self.per_page))
+
+    async def get_page(self, page_number):
+        if (entries := self._pages.pop(page_number, None)) is None:
+            start = max(page for page in self._after if page <= page_number)
+            entries = await self.fetch(
+                self._after[start], (page_number - start) * self.per_page, self.per_page
+            )
+            if entries:
+                self._after[page_number + 1] = self.key(entries[-1])
+        self._pages[page_number] = entries
+        if len(self._pages) > self.cached:
+            del self._pages[next(iter(self._pages))]
+        return entries
+
+    async def format_page(self, menu, page):
+        first = menu.current_page * self.per_page + 1
+        embed = self.embed.copy() if self.embed else discord.Embed()
+        embed.description = "\n".join(
+            self.format_entry(index, entry) for index, entry in enumerate(page, first)
+        )
+        return embed
+
+
 async def paginate(ctx, entries, per_page, *, template: discord.Embed = None, **kwargs):
     source = BareBonesMenu(entries, per_page=per_page, embed=template)
     menu = CSMenu(source, **kwargs)
@@ -0,0 +1,240 @@
+"""
+neo Discord bot
+Copyright (C) 2021 nickofolas
+
+neo is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+neo is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with neo.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import logging
+import multiprocessing
+import re
+import time
+from collections import Counter
+
+__all__ = ("RegexSandbox",)
+
+log = logging.getLogger(__name__)
+
+
+def _worker(conn, progress, started):
+    compiled = {}
+    conn.send(None)  # Ready
+    while True:
+        try:
+            content, patterns = conn.recv()
+        except EOFError:
+            return
+        if len(compiled) > 4096:
+            compiled.clear()
+        for index, pattern in enumerate(patterns):
+            if (regex := compiled.get(pattern)) is None:
+                regex = compiled[pattern] = re.compile(pattern, re.I)
+            # Compiling isn't charged, only the search itself is timed
+            started.value = time.monotonic()
+            progress.value = index
+            if m := regex.search(content):
+                conn.send((index, m.group(0)))
+        conn.send(None)
+
+
+class _Worker:
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.progress = context.Value("i", -1, lock=False)
+        self.started = context.Value("d", 0.0, lock=False)
+        self.process = context.Process(
+            target=_worker, args=(child, self.progress, self.started), daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.ready = False
+
+    def wait_ready(self, timeout):
+        """Whether the worker has finished starting within ``timeout`` seconds,
+        raising if it died"""
+        if not self.ready and self.conn.poll(max(0, timeout)):
+            self.conn.recv()  # EOFError if it died while starting
+            self.ready = True
+        return self.ready
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class RegexSandbox:
+    """Searches text with untrusted patterns in a worker process
+
+    Each message has a deadline, ``deadline`` seconds after it's queued, and
+    each pattern a time budget of its own. A worker which runs over either is
+    killed, and the patterns after the one it was on carry on with a standby
+    worker, which is kept started so that replacing one rarely waits on a new
+    process. Once the rest are searched, a pattern which ran out its own budget
+    is tried again alone on a fresh worker, and only reported if it runs out
+    the budget there too.
+
+    Messages are searched one at a time, and once ``max_queued`` are waiting,
+    further messages skip the search rather than queue behind them."""
+
+    retry_after = 60  # Seconds before starting workers again after a failure
+
+    def __init__(self, *, budget=0.1, deadline=None, max_queued=32):
+        self.budget = budget
+        self.deadline = deadline or budget * 5
+        self.max_queued = max_queued
+        self.stats = Counter()
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = asyncio.Lock()
+        self._queued = 0
+        self._worker = None
+        self._standby = None
+        self._failed_at = None
+        self._closed = False
+
+    def _replace(self):
+        """Swaps the current worker out for the standby"""
+        if self._worker is not None:
+            self._worker.kill()
+        self._worker, self._standby = self._standby, None
+        if self._closed:  # A search outlived close(), it mustn't start workers
+            return
+        if self._failed_at is not None:
+            if time.monotonic() - self._failed_at < self.retry_after:
+                return
+            self._failed_at = None
+        if self._worker is None:
+            self._worker = _Worker(self._context)
+        self._standby = _Worker(self._context)
+
+    def _ready_worker(self, deadline):
+        """The worker to search with, or None if it isn't ready by ``deadline``"""
+        if self._closed:
+            return None
+        if self._worker is None:
+            self._replace()
+        if (worker := self._worker) is None:
+            return None
+        try:
+            return worker if worker.wait_ready(deadline - time.monotonic()) else None
+        except (EOFError, OSError):
+            if self._closed:
+                return None
+            log.exception("The regex highlight worker failed to start")
+            self._failed_at = time.monotonic()
+            worker.kill()
+            if self._standby is not None:
+                self._standby.kill()
+            self._worker = self._standby = None
+            return None
+
+    def _run(self, worker, content, patterns, deadline):
+        """Returns the matches found, and the index of the pattern the worker
+        was on when it stopped, -1 if it never started one, or None if it
+        finished. Lastly, whether that pattern ran out its own budget, rather
+        than the message running out of time"""
+        worker.progress.value = -1
+        sent = time.monotonic()
+        worker.conn.send((content, patterns))
+        found = {}
+        while True:
+            index = worker.progress.value
+            started = worker.started.value if index >= 0 else sent
+            if worker.progress.value != index:
+                continue  # Moved on to the next pattern while reading
+            now = time.monotonic()
+            if now >= started + self.budget or now >= deadline:
+                if worker.progress.value == index:
+                    return found, index, now >= started + self.budget
+                continue
+            if worker.conn.poll(min(started + self.budget, deadline) - now):
+                if (result := worker.conn.recv()) is None:
+                    return found, None, False
+                index, match = result
+                found[index] = match
+
+    def _search(self, content, patterns, deadline):
+        found, suspects = {}, []
+        offset = 0
+        while offset < len(patterns):
+            if (worker := self._ready_worker(deadline)) is None:
+                break  # Failing to start, or out of time
+            try:
+                matches, stuck, overran = self._run(
+                    worker, content, patterns[offset:], deadline
+                )
+            except (EOFError, OSError):  # The worker died, carry on afresh
+                self._replace()
+                break
+            found.update({offset + index: m for index, m in matches.items()})
+            if stuck is None:
+                break
+            self._replace()
+            if stuck < 0 or not overran:
+                self.stats["cut_off"] += 1
+                break
+            # The rest of the patterns go on the standby, which is ready
+            suspects.append(offset + stuck)
+            offset += stuck + 1
+        # Slow machines and long batches aren't a pattern's fault, so it has to
+        # run out the budget alone on a fresh worker to be blamed
+        culprits = []
+        for index in suspects:
+            if (worker := self._ready_worker(deadline)) is None:
+                break
+            try:
+                matches, again, overran = self._run(
+                    worker, content, [patterns[index]], deadline
+                )
+            except (EOFError, OSError):
+                self._replace()
+                break
+            if again is None:
+                if matches:
+                    found[index] = matches[0]
+                continue
+            self._replace()
+            if not overran:
+                self.stats["cut_off"] += 1
+                break
+            culprits.append(index)
+        return found, culprits
+
+    async def search(self, content, patterns):
+        """Returns a dict of pattern index to match, and the indices of the
+        patterns which ran out the budget
+
+        Patterns go unsearched if the queue is full, or the deadline passes."""
+        if self._queued >= self.max_queued:
+            self.stats["skipped"] += 1
+            return {}, []
+        deadline = time.monotonic() + self.deadline
+        self._queued += 1
+        try:
+            async with self._lock:
+                if self._closed or time.monotonic() >= deadline:
+                    self.stats["skipped"] += 1
+                    return {}, []
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, self._search, content, patterns, deadline
+                )
+        finally:
+            self._queued -= 1
+
+    def close(self):
+        self._closed = True
+        for worker in (self._worker, self._standby):
+            if worker is not None:
+                worker.kill()
+        self._worker = self._standby = None